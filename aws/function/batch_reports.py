@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import time
+
+import clients
+
+logger = logging.getLogger()
+
+RUNNING_STATUSES = ('Submitted', 'Validating', 'Scheduled', 'InProgress', 'Stopping')
+# Jobs that ended without output to collect, PartiallyCompleted is collected record by record
+FAILED_STATUSES = ('Failed', 'Stopped', 'Expired')
+
+
+def record_id(index):
+    # Bedrock batch record ids are 11 character strings
+    return f"{index:011d}"
+
+
+class S3BatchBackend:
+    # Bedrock model invocation jobs read JSONL from S3 and write <input>.out under <output>/<job id>/
+    # A job needs at least 100 records, smaller backlogs should go through lambda_handler
+    min_records = 100
+
+    def __init__(self, bucket, prefix, role_arn, model_id):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.role_arn = role_arn
+        self.model_id = model_id
+
+    def put_lines(self, key, records):
+        body = "\n".join(json.dumps(record) for record in records)
+        clients.get('s3').put_object(Bucket=self.bucket, Key=key, Body=body.encode('utf-8'))
+
+    def iter_lines(self, key):
+        s3 = clients.get('s3')
+        try:
+            response = s3.get_object(Bucket=self.bucket, Key=key)
+        except s3.exceptions.NoSuchKey:
+            raise FileNotFoundError(f"s3://{self.bucket}/{key}")
+        for line in response['Body'].iter_lines():
+            if line:
+                yield json.loads(line)
+
+    def submit(self, job_name, input_key, output_prefix):
+        response = clients.get('bedrock').create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=self.model_id,
+            inputDataConfig={'s3InputDataConfig': {'s3InputFormat': 'JSONL', 's3Uri': f"s3://{self.bucket}/{input_key}"}},
+            outputDataConfig={'s3OutputDataConfig': {'s3Uri': f"s3://{self.bucket}/{output_prefix}"}},
+        )
+        job_arn = response['jobArn']
+        return {
+            'job_arn': job_arn,
+            'output_key': f"{output_prefix}{job_arn.split('/')[-1]}/{input_key.split('/')[-1]}.out",
+        }
+
+    def status(self, job):
+        # (status, message), the message explains failed and stopped jobs
+        response = clients.get('bedrock').get_model_invocation_job(jobIdentifier=job['job_arn'])
+        return response['status'], response.get('message')
+
+
+class LocalBatchBackend:
+    # Offline stand-in, "runs" the job on submit with invoke(model_input) -> model_output
+    min_records = 1
+
+    def __init__(self, directory, invoke):
+        self.directory = directory
+        self.invoke = invoke
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def put_lines(self, key, records):
+        with open(self._path(key), 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    def iter_lines(self, key):
+        with open(self._path(key)) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def submit(self, job_name, input_key, output_prefix):
+        output_key = f"{output_prefix}{job_name}/{input_key.split('/')[-1]}.out"
+        outputs = []
+        for record in self.iter_lines(input_key):
+            try:
+                outputs.append({**record, 'modelOutput': self.invoke(record['modelInput'])})
+            except Exception as e:
+                outputs.append({**record, 'error': {'errorMessage': str(e)}})
+        self.put_lines(output_key, outputs)
+        return {'job_arn': f"local/{job_name}", 'output_key': output_key}
+
+    def status(self, job):
+        return 'Completed', None
+
+
+def submit_batch(backend, findings, build_request, job_name=None, prefix="batch/"):
+    # Writes the prompts and a manifest of the findings, then starts the job
+    job_name = job_name or f"incident-reports-{int(time.time())}"
+    input_key = f"{prefix}{job_name}/input/records.jsonl"
+    manifest_key = f"{prefix}{job_name}/manifest.jsonl"
+
+    manifest = []
+    records = []
+    for index, row in enumerate(findings):
+        manifest.append({'recordId': record_id(index), 'doc': row})
+        records.append({'recordId': record_id(index), 'modelInput': build_request(row)})
+    if len(records) < backend.min_records:
+        raise ValueError(f"A batch job needs at least {backend.min_records} records, got {len(records)}")
+
+    backend.put_lines(manifest_key, manifest)
+    backend.put_lines(input_key, records)
+    job = backend.submit(job_name, input_key, f"{prefix}{job_name}/output/")
+    job.update({'job_name': job_name, 'manifest_key': manifest_key, 'records': len(records)})
+    logger.info(f"Submitted batch job {job}")
+    return job
+
+
+def collect_batch(backend, job, write_report):
+    # Fans the job output back into the per-finding report writer, in manifest order
+    docs = {entry['recordId']: entry['doc'] for entry in backend.iter_lines(job['manifest_key'])}
+    try:
+        outputs = {output['recordId']: output for output in backend.iter_lines(job['output_key'])}
+    except FileNotFoundError as e:
+        # A partially completed job may not have written its output file, every record is then an error
+        logger.warning(f"No batch output at {str(e)}")
+        outputs = {}
+
+    res = []
+    for rid, row in docs.items():
+        output = outputs.get(rid)
+        if output is None or 'modelOutput' not in output:
+            error = output['error'] if output else 'missing from batch output'
+            res.append({"doc": row, "error": str(error)})
+            continue
+        try:
+            report = output['modelOutput']['content'][0]['text']
+            write_report(row, report)
+        except Exception as e:
+            logger.exception(f"Error reading or writing the report for {row.get('Id')}: {str(e)}")
+            res.append({"doc": row, "error": str(e)})
+            continue
+        res.append({"doc": row, "response": report})
+    return res
@@ -0,0 +1,59 @@
+import logging
+import os
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger()
+
+# Sized so every finding worker (and its overlapped report call) gets a connection
+MAX_POOL_CONNECTIONS = int(os.environ.get(
+    "BOTO_MAX_POOL_CONNECTIONS",
+    str(max(10, 2 * int(os.environ.get("FINDING_CONCURRENCY", "4")) + 2)),
+))
+
+# Bedrock generations of ~9k tokens take minutes, everything else should fail fast
+READ_TIMEOUTS = {
+    'bedrock-runtime': 300,
+}
+DEFAULT_READ_TIMEOUT = int(os.environ.get("BOTO_READ_TIMEOUT", "30"))
+CONNECT_TIMEOUT = int(os.environ.get("BOTO_CONNECT_TIMEOUT", "5"))
+MAX_ATTEMPTS = int(os.environ.get("BOTO_MAX_ATTEMPTS", "5"))
+
+_clients = {}
+_construction_times = {}
+_lock = threading.Lock()
+
+
+def client_config(service_name):
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUTS.get(service_name, DEFAULT_READ_TIMEOUT),
+        retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS},
+        tcp_keepalive=True,
+    )
+
+
+def get(service_name):
+    # Clients are built on first use and reused for the life of the container
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(service_name)
+        if client is None:
+            start = time.perf_counter()
+            client = boto3.client(service_name, config=client_config(service_name))
+            _construction_times[service_name] = round(time.perf_counter() - start, 3)
+            logger.info(f"Created {service_name} client in {_construction_times[service_name]}s")
+            _clients[service_name] = client
+    return client
+
+
+def construction_times():
+    with _lock:
+        return dict(_construction_times)
@@ -0,0 +1,100 @@
+import os
+import re
+
+from tokens import estimate_tokens
+
+# Same module ships with the azure function (azure/MyFunctionProject/context_builder.py), keep them in sync
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+# Optional cap on passages from one document, 0 (default) leaves it to the dedupe and the budget.
+# A single-pdf corpus returns every passage under the same document id
+MAX_PASSAGES_PER_DOCUMENT = int(os.environ.get("MAX_PASSAGES_PER_DOCUMENT", "0"))
+# Share of the shorter passage's word trigrams found in an already selected one
+OVERLAP_THRESHOLD = 0.6
+
+_words = re.compile(r"\w+")
+_space = re.compile(r"\s+")
+
+
+def passage(content, title=None, doc_id=None, page=None, score=None):
+    return {'content': content or '', 'title': title, 'id': doc_id, 'page': page, 'score': score}
+
+
+def from_kendra(doc):
+    # retrieve_kendra_documents / hybrid / local results, only the page number of the attributes is kept
+    page = None
+    for attribute in doc.get('document_attributes') or []:
+        if attribute.get('Key') == '_excerpt_page_number':
+            page = (attribute.get('Value') or {}).get('LongValue')
+    return passage(doc.get('content'), doc.get('title'), doc.get('id'), page, doc.get('score'))
+
+
+def trigrams(words):
+    return set(zip(words, words[1:], words[2:])) or set(words)
+
+
+def overlaps(a, b):
+    if not a or not b:
+        return False
+    return len(a & b) / min(len(a), len(b)) >= OVERLAP_THRESHOLD
+
+
+def rank(passages, query=None):
+    # Retriever order first, query term coverage breaks near ties
+    terms = set(_words.findall((query or '').lower()))
+    scored = []
+    for position, item in enumerate(passages):
+        coverage = 0.0
+        if terms:
+            coverage = len(terms & set(_words.findall(item['content'].lower()))) / len(terms)
+        scored.append((1.0 / (1 + position) + 0.5 * coverage, position, item))
+    scored.sort(key=lambda entry: (-entry[0], entry[1]))
+    return [item for _, _, item in scored]
+
+
+def render(item, number):
+    header = f"[{number}] {item['title'] or 'untitled'}"
+    if item.get('page'):
+        header += f" (p. {item['page']})"
+    return f"{header}\n{_space.sub(' ', item['content']).strip()}"
+
+
+def select(passages, query=None, budget=CONTEXT_TOKEN_BUDGET):
+    # Greedy: best ranked first, one passage per document page, no passage that mostly repeats a
+    # selected one, at most MAX_PASSAGES_PER_DOCUMENT per document when set, and everything that
+    # still fits into the token budget
+    selected = []
+    per_document = {}
+    pages = set()
+    selected_trigrams = []
+    used = 0
+    for item in rank(passages, query):
+        if not item['content'].strip():
+            continue
+        document = item.get('id') or item.get('title')
+        if MAX_PASSAGES_PER_DOCUMENT and per_document.get(document, 0) >= MAX_PASSAGES_PER_DOCUMENT:
+            continue
+        if item.get('page') is not None and (document, item['page']) in pages:
+            continue
+        item_trigrams = trigrams(_words.findall(item['content'].lower()))
+        if any(overlaps(item_trigrams, other) for other in selected_trigrams):
+            continue
+        cost = estimate_tokens(render(item, len(selected) + 1))
+        if used + cost > budget:
+            if selected:
+                continue
+            # A best passage larger than the whole budget is cut down rather than dropped
+            item = {**item, 'content': item['content'][:budget * 3]}
+            cost = estimate_tokens(render(item, 1))
+        selected.append(item)
+        selected_trigrams.append(item_trigrams)
+        per_document[document] = per_document.get(document, 0) + 1
+        if item.get('page') is not None:
+            pages.add((document, item['page']))
+        used += cost
+    return selected
+
+
+def build_context(passages, query=None, budget=CONTEXT_TOKEN_BUDGET):
+    # Numbered passages separated by blank lines, the same input always renders the same text
+    return "\n\n".join(render(item, number) for number, item in enumerate(select(passages, query, budget), 1))
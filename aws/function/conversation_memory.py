@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import base64
+import json
+import logging
+import os
+import zlib
+
+import structured_log
+from tokens import estimate_tokens
+
+logger = logging.getLogger()
+
+# Lex session attribute holding the encoded memory, the old json list is still read from chat_history
+MEMORY_ATTRIBUTE = 'memory'
+LEGACY_ATTRIBUTE = 'chat_history'
+
+# Turns kept verbatim, older ones are folded into the rolling summary
+MEMORY_TURNS = int(os.environ.get("MEMORY_TURNS", "6"))
+# Encoded size cap, well inside the lex session attribute limits
+MEMORY_MAX_BYTES = int(os.environ.get("MEMORY_MAX_BYTES", "4096"))
+# Characters of each answer kept, 0 keeps only the questions
+MEMORY_ANSWER_CHARS = int(os.environ.get("MEMORY_ANSWER_CHARS", "200"))
+# History handed to the prompts
+MEMORY_TOKEN_BUDGET = int(os.environ.get("MEMORY_TOKEN_BUDGET", "600"))
+SUMMARY_CHARS = 1200
+# How long the end of a turn waits for a summary update before leaving it to the next turn
+SUMMARY_WAIT_SECONDS = float(os.environ.get("SUMMARY_WAIT_SECONDS", "0.5"))
+
+_summary_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def empty():
+    # turns: [question, answer] pairs, pending: turns evicted from the window but not yet summarized
+    return {'summary': '', 'turns': [], 'pending': []}
+
+
+def load(session_attributes):
+    session_attributes = session_attributes or {}
+    try:
+        if session_attributes.get(MEMORY_ATTRIBUTE):
+            data = zlib.decompress(base64.urlsafe_b64decode(session_attributes[MEMORY_ATTRIBUTE]))
+            return {**empty(), **json.loads(data)}
+        if session_attributes.get(LEGACY_ATTRIBUTE):
+            turns = [[question, ''] for question, _ in json.loads(session_attributes[LEGACY_ATTRIBUTE])]
+            return {**empty(), 'turns': turns}
+    except (ValueError, TypeError, zlib.error) as e:
+        logger.warning(f"Discarding unreadable conversation memory: {str(e)}")
+    return empty()
+
+
+def _pack(memory):
+    data = json.dumps(memory, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(zlib.compress(data, 9)).decode('ascii')
+
+
+def encode(memory):
+    # Compact json, deflated and base64 encoded. Over the size cap the oldest pending turns go
+    # first, then the oldest verbatim turns, then the summary is shortened
+    memory = {**memory, 'turns': list(memory['turns']), 'pending': list(memory['pending'])}
+    encoded = _pack(memory)
+    while len(encoded) > MEMORY_MAX_BYTES:
+        if memory['pending']:
+            memory['pending'].pop(0)
+        elif len(memory['turns']) > 1:
+            memory['turns'].pop(0)
+        elif len(memory['summary']) > 100:
+            memory['summary'] = memory['summary'][len(memory['summary']) // 2:]
+        else:
+            break
+        encoded = _pack(memory)
+    return encoded
+
+
+def add_turn(memory, question, answer):
+    memory['turns'].append([question, (answer or '')[:MEMORY_ANSWER_CHARS]])
+    while len(memory['turns']) > MEMORY_TURNS:
+        memory['pending'].append(memory['turns'].pop(0))
+
+
+def last_question(memory):
+    if memory['turns']:
+        return memory['turns'][-1][0]
+    return None
+
+
+def turn_lines(turns):
+    lines = []
+    for question, answer in turns:
+        lines.append(f"User: {question}")
+        if answer:
+            lines.append(f"Assistant: {answer}")
+    return lines
+
+
+def history_text(memory, budget=MEMORY_TOKEN_BUDGET):
+    # Summary first, then as many of the newest turns as fit into the budget. Pending turns are
+    # not in the summary yet, so they count as the oldest verbatim turns until they are folded in
+    summary = f"Summary of the earlier conversation: {memory['summary']}" if memory['summary'] else ''
+    used = estimate_tokens(summary)
+    kept = []
+    for turn in reversed(memory['pending'] + memory['turns']):
+        lines = turn_lines([turn])
+        cost = estimate_tokens("\n".join(lines))
+        if used + cost > budget:
+            break
+        kept[:0] = lines
+        used += cost
+    return "\n".join(([summary] if summary else []) + kept)
+
+
+def extractive_summary(summary, turns):
+    # Fallback without a model call, the evicted questions appended to the summary
+    text = " ".join([summary] + [f"Asked: {question}" for question, _ in turns]).strip()
+    return text[-SUMMARY_CHARS:]
+
+
+def start_summary(memory, summarize):
+    # Folds the pending turns into the summary on a worker thread while the turn is answered,
+    # summarize(summary, lines) -> new summary text
+    if not memory['pending']:
+        return None
+    pending = list(memory['pending'])
+    summary = memory['summary']
+
+    def run():
+        try:
+            text = summarize(summary, "\n".join(turn_lines(pending)))
+            return (text or '').strip()[:SUMMARY_CHARS], len(pending)
+        except Exception as e:
+            logger.warning(f"Summary update failed, using the questions instead: {str(e)}")
+            return extractive_summary(summary, pending), len(pending)
+
+    return _summary_executor.submit(run)
+
+
+def finish_summary(memory, update, timeout=SUMMARY_WAIT_SECONDS):
+    # Applies a finished update, an unfinished one is redone next turn from the still pending turns
+    if update is None:
+        return
+    try:
+        summary, folded = update.result(timeout=timeout)
+    except TimeoutError:
+        structured_log.log_stage('event', 'memory_summary_pending', pending=len(memory['pending']))
+        return
+    memory['summary'] = summary
+    memory['pending'] = memory['pending'][folded:]
@@ -0,0 +1,246 @@
+from io import BytesIO
+import os
+import threading
+
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.shared import Pt
+from lxml import html as lxml_html
+import markdown
+
+# Optional .docx whose styles, header and footer every report starts from
+DOCX_TEMPLATE = os.environ.get("DOCX_TEMPLATE")
+
+MARKDOWN_EXTENSIONS = ['tables', 'fenced_code', 'sane_lists']
+CODE_FONT = 'Courier New'
+
+_template_bytes = None
+_template_lock = threading.Lock()
+_local = threading.local()
+_style_ids = {}
+
+
+def template_bytes():
+    # Read (or build) the template once per container, each report parses it from memory
+    global _template_bytes
+    if _template_bytes is None:
+        with _template_lock:
+            if _template_bytes is None:
+                if DOCX_TEMPLATE:
+                    with open(DOCX_TEMPLATE, 'rb') as f:
+                        _template_bytes = f.read()
+                else:
+                    buffer = BytesIO()
+                    Document().save(buffer)
+                    _template_bytes = buffer.getvalue()
+    return _template_bytes
+
+
+def markdown_html(text):
+    # markdown.Markdown instances are reusable but not thread safe, keep one per thread
+    md = getattr(_local, 'markdown', None)
+    if md is None:
+        md = _local.markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    return md.reset().convert(text)
+
+
+def style_id(doc, name, fallback='Normal'):
+    # Resolving a style by name scans every style in the template, so the ids are
+    # looked up once per container and written straight into pStyle afterwards
+    key = (name, fallback)
+    if key not in _style_ids:
+        try:
+            _style_ids[key] = doc.styles[name].style_id
+        except KeyError:
+            _style_ids[key] = doc.styles[fallback].style_id
+    return _style_ids[key]
+
+
+def add_paragraph(doc, style=None, fallback='Normal'):
+    paragraph = doc.add_paragraph()
+    if style:
+        paragraph._p.style = style_id(doc, style, fallback)
+    return paragraph
+
+
+def add_text(paragraph, text, bold=False, italic=False, code=False):
+    if not text:
+        return
+    # Soft line breaks in markdown are spaces, python-docx would turn them into breaks
+    run = paragraph.add_run(text.replace('\n', ' '))
+    if bold:
+        run.bold = True
+    if italic:
+        run.italic = True
+    if code:
+        run.font.name = CODE_FONT
+
+
+def render_inline(paragraph, node, bold=False, italic=False, code=False):
+    # Renders the children of node (text, strong/em/code/a/br) into paragraph
+    add_text(paragraph, node.text, bold, italic, code)
+    for child in node:
+        tag = child.tag if isinstance(child.tag, str) else ''
+        if tag == 'br':
+            paragraph.add_run().add_break()
+        elif tag in ('ul', 'ol', 'pre', 'table', 'blockquote'):
+            # Block content inside a list item is rendered by the caller
+            pass
+        else:
+            render_inline(
+                paragraph,
+                child,
+                bold or tag in ('strong', 'b'),
+                italic or tag in ('em', 'i'),
+                code or tag == 'code',
+            )
+        add_text(paragraph, child.tail, bold, italic, code)
+
+
+def restart_numbering(doc, style):
+    # Paragraphs of a numbered list style share the style's numId, so every <ol> would continue
+    # counting from the previous one. Each list gets its own w:num over the same abstract
+    # numbering that starts again at 1, returns (numId, ilvl) or None for unnumbered styles
+    ppr = doc.styles.get_by_id(style_id(doc, style), WD_STYLE_TYPE.PARAGRAPH).element.pPr
+    if ppr is None or ppr.numPr is None or ppr.numPr.numId is None:
+        return None
+    numbering = doc.part.numbering_part.element
+    ilvl = ppr.numPr.ilvl.val if ppr.numPr.ilvl is not None else 0
+    num = numbering.add_num(numbering.num_having_numId(ppr.numPr.numId.val).abstractNumId.val)
+    num.add_lvlOverride(ilvl=ilvl).add_startOverride(1)
+    return num.numId, ilvl
+
+
+def render_list(doc, node, level):
+    kind = 'List Number' if node.tag == 'ol' else 'List Bullet'
+    style = kind if level == 0 else f"{kind} {min(level + 1, 3)}"
+    continue_style = 'List Continue' if level == 0 else f"List Continue {min(level + 1, 3)}"
+    numbering = restart_numbering(doc, style) if node.tag == 'ol' else None
+    for item in node:
+        if item.tag != 'li':
+            continue
+        paragraph = current = add_paragraph(doc, style, kind)
+        if numbering:
+            num_pr = paragraph._p.get_or_add_pPr().get_or_add_numPr()
+            num_pr.get_or_add_ilvl().val = numbering[1]
+            num_pr.get_or_add_numId().val = numbering[0]
+        if item.text and item.text.strip():
+            add_text(paragraph, item.text)
+        for child in item:
+            if child.tag in ('ul', 'ol'):
+                render_list(doc, child, level + 1)
+            elif child.tag == 'p':
+                # Loose lists wrap item text in <p>, the first one is the item itself
+                if current is paragraph and not paragraph.runs:
+                    render_inline(paragraph, child)
+                else:
+                    current = add_paragraph(doc, continue_style)
+                    render_inline(current, child)
+            elif child.tag in ('pre', 'table', 'blockquote'):
+                render_block(doc, child, level + 1)
+            else:
+                render_inline_node(current, child)
+            if child.tail and child.tail.strip():
+                add_text(current, child.tail)
+
+
+def render_inline_node(paragraph, node):
+    tag = node.tag
+    if tag == 'br':
+        paragraph.add_run().add_break()
+        return
+    render_inline(paragraph, node, tag in ('strong', 'b'), tag in ('em', 'i'), tag == 'code')
+
+
+def render_code(doc, node):
+    paragraph = add_paragraph(doc, 'No Spacing')
+    lines = node.text_content().rstrip('\n').split('\n')
+    run = paragraph.add_run()
+    run.font.name = CODE_FONT
+    run.font.size = Pt(9)
+    for index, line in enumerate(lines):
+        if index:
+            run.add_break()
+        run.add_text(line)
+
+
+def render_table(doc, node):
+    rows = [row for row in node.iter('tr')]
+    if not rows:
+        return
+    columns = max(len([cell for cell in row if cell.tag in ('th', 'td')]) for row in rows)
+    table = doc.add_table(rows=len(rows), cols=columns)
+    table._tbl.tblStyle_val = style_id(doc, 'Table Grid', 'Normal Table')
+    for row, table_row in zip(rows, table.rows):
+        cells = [cell for cell in row if cell.tag in ('th', 'td')]
+        for cell, table_cell in zip(cells, table_row.cells):
+            render_inline(table_cell.paragraphs[0], cell, bold=cell.tag == 'th')
+
+
+def render_block(doc, node, level=0):
+    tag = node.tag
+    if tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
+        render_inline(add_paragraph(doc, f"Heading {tag[1]}"), node)
+    elif tag == 'p':
+        render_inline(add_paragraph(doc), node)
+    elif tag in ('ul', 'ol'):
+        render_list(doc, node, level)
+    elif tag == 'pre':
+        render_code(doc, node)
+    elif tag == 'table':
+        render_table(doc, node)
+    elif tag == 'blockquote':
+        for child in node:
+            if child.tag == 'p':
+                render_inline(add_paragraph(doc, 'Quote'), child)
+            else:
+                render_block(doc, child, level)
+    elif tag == 'hr':
+        add_paragraph(doc)
+    elif isinstance(tag, str):
+        render_inline(add_paragraph(doc), node)
+
+
+def markdown_to_docx(text):
+    # One pass over the parsed markdown tree, each block appended straight to the document
+    doc = Document(BytesIO(template_bytes()))
+    root = lxml_html.fragment_fromstring(markdown_html(text) or '<p></p>', create_parent='div')
+    for node in root:
+        render_block(doc, node)
+    return doc
+
+
+if __name__ == "__main__":
+    # Benchmark: python docx_report.py
+    import time
+
+    section = """## Incident Response Process
+
+Finding **S3.8** on bucket *my-sensitive-data-bucket* is `NON_COMPLIANT`.
+
+1. Acquire, preserve, document evidence
+    - Export the bucket policy and **ACLs**
+    - Snapshot the CloudTrail events
+2. Identify the remediation steps
+
+| Step | Owner | Status |
+|------|-------|--------|
+| Enable default encryption | Cloud team | *Open* |
+| Review bucket policy | Security | Done |
+
+```bash
+aws s3api put-bucket-encryption --bucket my-sensitive-data-bucket \\
+  --server-side-encryption-configuration file://sse.json
+```
+
+"""
+    for size_kb in (10, 25, 50):
+        report = "# AnyCompany Incident Report\n\n" + section * (size_kb * 1024 // len(section) + 1)
+        markdown_to_docx(report)
+        runs = 20
+        start = time.perf_counter()
+        for _ in range(runs):
+            buffer = BytesIO()
+            markdown_to_docx(report).save(buffer)
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"{len(report) // 1024} KB markdown -> {len(buffer.getvalue()) // 1024} KB docx in {elapsed * 1000:.1f} ms")
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+
+from llm_cache import DynamoDBCache, FileCache, S3Cache
+
+
+def material_fields(finding):
+    # Fields that change the report, workflow / note / timestamp updates are ignored
+    severity = finding.get('Severity')
+    if isinstance(severity, dict):
+        severity = severity.get('Label')
+    resources = finding.get('Resources')
+    if isinstance(resources, list):
+        resources = [
+            {'Type': r.get('Type'), 'Id': r.get('Id'), 'Details': r.get('Details')} if isinstance(r, dict) else r
+            for r in resources
+        ]
+    return {
+        'Id': finding.get('Id'),
+        'Compliance': (finding.get('Compliance') or {}).get('Status'),
+        'Severity': severity,
+        'Resources': resources if resources is not None else finding.get('ResourceType'),
+        'Remediation': finding.get('Remediation'),
+    }
+
+
+def finding_fingerprint(finding):
+    payload = json.dumps(material_fields(finding), sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class FindingIndex:
+
+    def __init__(self, store):
+        self.store = store
+
+    def _key(self, finding):
+        return hashlib.sha256(str(finding.get('Id')).encode("utf-8")).hexdigest()
+
+    def is_unchanged(self, finding):
+        return self.store.get(self._key(finding)) == finding_fingerprint(finding)
+
+    def record(self, finding):
+        self.store.set(self._key(finding), finding_fingerprint(finding))
+
+
+def index_from_env():
+    # FINDING_INDEX_BACKEND: none | file | s3 | dynamodb
+    backend = os.environ.get("FINDING_INDEX_BACKEND", "none").lower()
+    ttl = int(os.environ.get("FINDING_INDEX_TTL", str(30 * 86400)))
+    if backend == "file":
+        return FindingIndex(FileCache(os.environ.get("FINDING_INDEX_DIR", "/tmp/finding-index"), ttl=ttl))
+    if backend == "s3":
+        return FindingIndex(S3Cache(os.environ["FINDING_INDEX_BUCKET"], os.environ.get("FINDING_INDEX_PREFIX", "finding-index/"), ttl=ttl))
+    if backend == "dynamodb":
+        return FindingIndex(DynamoDBCache(os.environ["FINDING_INDEX_TABLE"], ttl=ttl))
+    return None
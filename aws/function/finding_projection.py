@@ -0,0 +1,125 @@
+import json
+import threading
+
+from securityhub_findings import get_path
+import serialization
+import structured_log
+from tokens import estimate_tokens
+
+# Output name -> dotted path, only what an engineer needs to triage the finding
+SECURITY_HUB_FIELDS = {
+    'Id': 'Id',
+    'Title': 'Title',
+    'Description': 'Description',
+    'Severity': 'Severity.Label',
+    'Types': 'Types',
+    'GeneratorId': 'GeneratorId',
+    'AwsAccountId': 'AwsAccountId',
+    'Region': 'Region',
+    'Compliance': 'Compliance.Status',
+    'ComplianceReasons': 'Compliance.StatusReasons',
+    'Remediation': 'Remediation.Recommendation.Text',
+    'RemediationUrl': 'Remediation.Recommendation.Url',
+    'FirstObservedAt': 'FirstObservedAt',
+    'UpdatedAt': 'UpdatedAt',
+}
+
+RESOURCE_FIELDS = {
+    'Type': 'Type',
+    'Id': 'Id',
+    'Region': 'Region',
+    'Tags': 'Tags',
+}
+
+GUARDDUTY_FIELDS = {
+    **SECURITY_HUB_FIELDS,
+    'ActionType': 'ProductFields.aws/guardduty/service/action/actionType',
+    'ResourceRole': 'ProductFields.aws/guardduty/service/resourceRole',
+    'Count': 'ProductFields.aws/guardduty/service/count',
+    'EventFirstSeen': 'ProductFields.aws/guardduty/service/eventFirstSeen',
+    'EventLastSeen': 'ProductFields.aws/guardduty/service/eventLastSeen',
+    'RemoteIp': 'ProductFields.aws/guardduty/service/action/networkConnectionAction/remoteIpDetails/ipAddressV4',
+    'RemoteCountry': 'ProductFields.aws/guardduty/service/action/networkConnectionAction/remoteIpDetails/country/countryName',
+    'ApiCalled': 'ProductFields.aws/guardduty/service/action/awsApiCallAction/api',
+    'Threat': 'ProductFields.aws/guardduty/service/additionalInfo/threatName',
+}
+
+CONFIG_FIELDS = {
+    'Rule': 'detail.configRuleName',
+    'ResourceType': 'detail.resourceType',
+    'ResourceId': 'detail.resourceId',
+    'AwsAccountId': 'detail.awsAccountId',
+    'Region': 'detail.awsRegion',
+    'Compliance': 'detail.newEvaluationResult.complianceType',
+    'PreviousCompliance': 'detail.oldEvaluationResult.complianceType',
+    'Annotation': 'detail.newEvaluationResult.annotation',
+    'RecordedAt': 'detail.newEvaluationResult.resultRecordedTime',
+    'Resources': 'resources',
+}
+
+_stats_lock = threading.Lock()
+_stats = {'findings': 0, 'original_tokens': 0, 'projected_tokens': 0}
+
+
+def finding_source(event):
+    if not isinstance(event, dict):
+        return 'unknown'
+    if event.get('source') == 'aws.config' or 'configRuleName' in (event.get('detail') or {}):
+        return 'config'
+    if 'SchemaVersion' in event and 'ProductArn' in event:
+        product = get_path(event, 'ProductFields.aws/securityhub/ProductName') or event['ProductArn']
+        if 'guardduty' in product.lower():
+            return 'guardduty'
+        return 'securityhub'
+    return 'unknown'
+
+
+def select(event, fields):
+    projected = {}
+    for name, path in fields.items():
+        value = get_path(event, path)
+        if value not in (None, '', [], {}):
+            projected[name] = value
+    return projected
+
+
+def project_finding(event):
+    # The config lambda receives the EventBridge event wrapped by the input transformer
+    if isinstance(event, dict) and isinstance(event.get('event'), dict):
+        event = event['event']
+
+    source = finding_source(event)
+    if source == 'config':
+        return select(event, CONFIG_FIELDS)
+    if source in ('securityhub', 'guardduty'):
+        projected = select(event, GUARDDUTY_FIELDS if source == 'guardduty' else SECURITY_HUB_FIELDS)
+        resources = [select(resource, RESOURCE_FIELDS) for resource in event.get('Resources') or []]
+        if resources:
+            projected['Resources'] = resources
+        return projected
+    # Already compact records (e.g. from the sweep) go through unchanged
+    return event
+
+
+def encode_finding(event):
+    # Compact JSON of the projection, encoded once and shared by every prompt of the finding
+    text = json.dumps(project_finding(event), separators=(',', ':'), ensure_ascii=False, default=str)
+
+    original_tokens = estimate_tokens(serialization.encode(event))
+    projected_tokens = estimate_tokens(text)
+    with _stats_lock:
+        _stats['findings'] += 1
+        _stats['original_tokens'] += original_tokens
+        _stats['projected_tokens'] += projected_tokens
+    structured_log.log_stage('prompt', 'finding_projection', original_tokens=original_tokens,
+                             projected_tokens=projected_tokens)
+    return text
+
+
+def projection_stats(since=None):
+    with _stats_lock:
+        stats = dict(_stats)
+    if since:
+        stats = {name: value - since.get(name, 0) for name, value in stats.items()}
+    stats['tokens_saved'] = stats['original_tokens'] - stats['projected_tokens']
+    return stats
@@ -0,0 +1,234 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+import clients
+import finding_projection
+import llm_cache
+import model_routing
+import report_stream
+import retrieval_cache
+import retrievers
+import serialization
+import structured_log
+import tokens
+
+# Bedrock and kendra plumbing shared by the report lambdas (lambda_function.py, lambda_aws_config_function.py)
+
+# Run report generation beside the search query / kendra lookup
+OVERLAP_ANALYSIS = os.environ.get("OVERLAP_ANALYSIS", "true").lower() == "true"
+
+# Stream the report out of bedrock (invoke_model_with_response_stream) into its sinks
+STREAM_REPORTS = os.environ.get("STREAM_REPORTS", "false").lower() == "true"
+
+# Bedrock response cache, call sites opt in with process_prompt(..., cache=response_cache)
+response_cache = llm_cache.cache_from_env()
+
+# Kendra results, near-duplicate search queries share one kendra call
+kendra_cache = retrieval_cache.cache_from_env()
+
+
+def query_kendra(kendra_id, query):
+    def fetch():
+        # Perform the search using Kendra
+        response = clients.get('kendra').query(
+            IndexId=kendra_id,
+            QueryText=query
+        )
+
+        # Extract relevant information from the response
+        results = []
+        for result in response['ResultItems']:
+            document = {
+                'id': result['DocumentId'],
+                'title': result['DocumentTitle']['Text'],
+                'excerpt': result['DocumentExcerpt']['Text'],
+                'uri': result.get('DocumentURI', '')
+            }
+            results.append(document)
+
+        return results
+
+    if kendra_cache is None:
+        return fetch()
+    return kendra_cache.get_or_fetch(kendra_id, 'query', query, fetch)
+
+
+# Default model, calls with a route from model_routing.route() override it
+MODEL_ID = model_routing.FAST_MODEL
+MODEL_PARAMS = {
+    "anthropic_version": "bedrock-2023-05-31",
+    "max_tokens": model_routing.output_limit(MODEL_ID),
+}
+
+# Mark the static system prompts as a bedrock prompt cache prefix, needs a model
+# with prompt caching (e.g. claude 3.5 haiku / 3.7 sonnet) and a prefix above its minimum size
+PROMPT_CACHING = os.environ.get("PROMPT_CACHING", "false").lower() == "true"
+
+# Token usage of every bedrock call in this container, including prompt cache reads / writes
+model_usage = tokens.TokenUsage()
+
+
+def usage_snapshot():
+    # Container lifetime counters, usage_since() turns them into one invocation's share
+    return {
+        'llm_cache': response_cache.stats() if response_cache else None,
+        'retrieval_cache': kendra_cache.stats() if kendra_cache else None,
+        'projection': finding_projection.projection_stats(),
+        'bedrock_usage': model_usage.totals(),
+    }
+
+
+def usage_since(before):
+    usage_after = model_usage.totals()
+    return {
+        'llm_cache': response_cache.stats(since=before['llm_cache']) if response_cache else None,
+        'retrieval_cache': kendra_cache.stats(since=before['retrieval_cache']) if kendra_cache else None,
+        'projection': finding_projection.projection_stats(since=before['projection']),
+        'bedrock_usage': {field: usage_after[field] - before['bedrock_usage'][field] for field in usage_after},
+    }
+
+
+def system_blocks(system, cache_system=False):
+    if not (cache_system and PROMPT_CACHING and system):
+        return system
+    return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+
+def model_request(route=None):
+    if route is None:
+        return MODEL_ID, MODEL_PARAMS
+    return route['model_id'], {**MODEL_PARAMS, "max_tokens": route['max_tokens']}
+
+
+def prompt_request(system, prompt, cache_system=False, params=MODEL_PARAMS):
+    return {
+        **params,
+        "system": system_blocks(system, cache_system),
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def prompt_body(system, prompt, cache_system=False, params=MODEL_PARAMS):
+    return json.dumps(prompt_request(system, prompt, cache_system, params))
+
+
+def process_prompt(system, prompt, cache=None, cache_system=False, route=None):
+    model_id, params = model_request(route)
+
+    def invoke():
+        response = clients.get('bedrock-runtime').invoke_model(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=prompt_body(system, prompt, cache_system, params)
+        )
+
+        response_body = json.loads(response['body'].read())
+        structured_log.log_stage('bedrock', 'bedrock_response', response_body, model_id=model_id)
+        model_usage.add(response_body.get('usage'))
+        return response_body['content'][0]['text']
+
+    if cache is None:
+        return invoke()
+    return cache.get_or_compute(llm_cache.cache_key(model_id, system, prompt, params), invoke)
+
+
+def process_prompt_stream(system, prompt, cache=None, cache_system=False, route=None):
+    # Yields the completion text as bedrock generates it
+    model_id, params = model_request(route)
+    key = llm_cache.cache_key(model_id, system, prompt, params)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    response = clients.get('bedrock-runtime').invoke_model_with_response_stream(
+        modelId=model_id,
+        contentType="application/json",
+        accept="application/json",
+        body=prompt_body(system, prompt, cache_system, params)
+    )
+
+    parts = []
+    for chunk in report_stream.iter_text_chunks(response, usage=model_usage):
+        parts.append(chunk)
+        yield chunk
+
+    if cache is not None:
+        cache.set(key, "".join(parts))
+
+
+def search_related_docs(kendra_id, finding, route=None):
+    user = f"""I want to search aws opensearch for related documents
+    I want you to review findings from security hub and extract important keywords create a search summary
+    <finding>
+    {finding}
+    </finding>
+
+    Only return the final query in text format, don't mention anything else
+    Create a query in natural language extracting important terms.
+
+    The final search query should be less than 500 words.
+    """
+    search_query = process_prompt("", user, cache=response_cache, route=route)
+
+    # RETRIEVER picks kendra, the local vector index or both
+    docs = retrievers.search(search_query, lambda query: query_kendra(kendra_id, query), retrievers.as_query_result)
+    structured_log.log_stage('kendra', 'kendra_query', lambda: serialization.encode(docs), results=len(docs))
+    return search_query, docs
+
+
+def report_prompt(finding):
+    return f"""Review the finding and summarize actionable next steps,
+    <finding>
+    {finding}
+    </finding>
+
+    This report text will be finally saved in word format, so i need output in markdown format.
+    Create a detailed and in-depth report.
+    Provide output in proper markdown format with headings/bullet points etc.
+    """
+
+
+def analyze_finding(kendra_id, event, system, sinks=None, deadline=None, routes=None):
+    # Report for one finding under the calling lambda's system prompt, returns (report, search query, kendra docs)
+    finding = finding_projection.encode_finding(event)
+    user = report_prompt(finding)
+
+    # Cheap model for keyword extraction, report model by severity and time left
+    severity = model_routing.finding_severity(event)
+    query_route = model_routing.route('query', severity, deadline)
+    report_route = model_routing.route('report', severity, deadline)
+    if routes is not None:
+        routes.update(query=query_route, report=report_route)
+
+    # The report prompt does not depend on the kendra docs, so it can run
+    # while the search query is generated and kendra is queried
+    def generate_report():
+        # With sinks the report is streamed into them chunk by chunk
+        if sinks is None:
+            return process_prompt(system, user, cache=response_cache, cache_system=True, route=report_route)
+        return report_stream.write_stream(
+            process_prompt_stream(system, user, cache=response_cache, cache_system=True, route=report_route), *sinks)
+
+    if OVERLAP_ANALYSIS:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            report = executor.submit(generate_report)
+            search_query, docs = search_related_docs(kendra_id, finding, query_route)
+            response = report.result()
+    else:
+        search_query, docs = search_related_docs(kendra_id, finding, query_route)
+        response = generate_report()
+    return response, search_query, docs
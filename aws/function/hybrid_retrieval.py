@@ -0,0 +1,71 @@
+import re
+
+from tokens import estimate_tokens
+
+# Standard RRF damping constant, keeps a single first place from dominating the fused order
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(rankings, key, k=RRF_K):
+    # rankings: ranked lists of items, key(item) -> identity across lists.
+    # Returns (key, score) pairs, best first
+    scores = {}
+    for ranking in rankings:
+        # A list counts once per key, at its best rank
+        seen = set()
+        for rank, item in enumerate(ranking, 1):
+            item_key = key(item)
+            if item_key in seen:
+                continue
+            seen.add(item_key)
+            scores[item_key] = scores.get(item_key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+
+
+def document_key(item):
+    return item.get('id') or item.get('uri') or item.get('title')
+
+
+_space = re.compile(r"\s+")
+
+
+def page_number(item):
+    for attribute in item.get('document_attributes') or []:
+        if attribute.get('Key') == '_excerpt_page_number':
+            return (attribute.get('Value') or {}).get('LongValue')
+    return None
+
+
+def passage_key(item):
+    # A page of a document, or the text itself when there is no page number
+    page = page_number(item)
+    if page is None:
+        page = _space.sub(' ', item.get('content') or item.get('excerpt') or '').strip()[:200]
+    return document_key(item), page
+
+
+def fuse(passages, excerpts, token_budget):
+    # passages: retrieve_kendra_documents results, excerpts: query_kendra documents.
+    # One entry per passage (document page), the retrieve passage when retrieve returned that
+    # page and the query excerpt otherwise, in fused order until the token budget is spent
+    best = {}
+    for passage in passages:
+        best.setdefault(passage_key(passage), passage)
+    for excerpt in excerpts:
+        best.setdefault(passage_key(excerpt), {
+            'id': excerpt.get('id'),
+            'title': excerpt.get('title'),
+            'content': excerpt.get('excerpt'),
+            'document_attributes': excerpt.get('document_attributes') or [],
+        })
+
+    documents = []
+    used = 0
+    for key, score in reciprocal_rank_fusion([passages, excerpts], passage_key):
+        document = best[key]
+        cost = estimate_tokens(document.get('content'))
+        if documents and used + cost > token_budget:
+            continue
+        used += cost
+        documents.append({**document, 'score': round(score, 5)})
+    return documents
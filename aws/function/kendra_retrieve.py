@@ -0,0 +1,73 @@
+import logging
+
+import clients
+
+logger = logging.getLogger()
+
+# retrieve returns at most 100 passages per page
+MAX_PAGE_SIZE = 100
+
+# Only the page number is used by the prompts (context_builder.from_kendra)
+DEFAULT_ATTRIBUTES = ('_excerpt_page_number',)
+
+
+def project(item):
+    # Shape of a retrieve_kendra_documents result
+    return {
+        'id': item.get('DocumentId'),
+        'title': item.get('DocumentTitle'),
+        'content': item.get('Content'),
+        'document_attributes': item.get('DocumentAttributes', []),
+    }
+
+
+def retrieve_page(index_id, query, page_size=10, page_number=1, attributes=DEFAULT_ATTRIBUTES):
+    # One retrieve call on the shared kendra client, attributes=None returns all of them
+    request = {
+        'IndexId': index_id,
+        'QueryText': query,
+        'PageSize': min(page_size, MAX_PAGE_SIZE),
+        'PageNumber': page_number,
+    }
+    if attributes:
+        request['RequestedDocumentAttributes'] = list(attributes)
+    response = clients.get('kendra').retrieve(**request)
+    return {
+        'query_id': response.get('QueryId'),
+        'warning': response.get('WarningMessage'),
+        'passages': [project(item) for item in response.get('ResultItems', [])],
+    }
+
+
+def iter_passages(index_id, query, page_size=10, max_items=None, attributes=DEFAULT_ATTRIBUTES, page_number=1):
+    # Yields one passage at a time, the next page is only requested once the current one is used up.
+    # retrieve has no next token, a short page is the last one
+    returned = 0
+    while True:
+        page = retrieve_page(index_id, query, page_size, page_number, attributes)
+        for passage in page['passages']:
+            yield passage
+            returned += 1
+            if max_items and returned >= max_items:
+                return
+        if len(page['passages']) < min(page_size, MAX_PAGE_SIZE):
+            return
+        page_number += 1
+
+
+if __name__ == "__main__":
+    # Pages against the local stub: python kendra_retrieve.py [passages] [page_size] [take]
+    import itertools
+    import sys
+
+    from lex_benchmark import StubKendra
+
+    logging.basicConfig(level=logging.INFO)
+    total, page_size, take = (int(arg) for arg in (sys.argv[1:] + ["45", "10", "25"])[:3])
+    stub = StubKendra(passages=total)
+    clients._clients['kendra'] = stub
+
+    passages = list(itertools.islice(iter_passages("stub-index", "block public access", page_size), take))
+    print(f"took {len(passages)} of {total} passages in {stub.calls} retrieve calls of {page_size}")
+    first = retrieve_page("stub-index", "block public access", page_size, 2)['passages'][0]
+    print(f"page 2 starts with {first['id']}, attributes {[a['Key'] for a in first['document_attributes']]}")
@@ -1,243 +1,347 @@
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 import os
+import time
 import logging
-import boto3
-import jsonpickle
 import json
 
+import batch_reports
+import clients
+import finding_index as finding_index_store
+import finding_projection
+import finding_reports
+import model_routing
+import report_stream
+import resolvers
+import securityhub_findings
+import serialization
+import sqs_batch
+import structured_log
+import sweep_checkpoint
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-client = boto3.client('lambda')
 
-bedrock_runtime = boto3.client('bedrock-runtime')
-kendra = boto3.client('kendra')
-securityhub = boto3.client('securityhub')
+bucket_name = 'test-stack-saurabh'  # Replace with your S3 bucket name
 
+# Number of findings analysed in parallel, 1 keeps the old sequential behaviour
+FINDING_CONCURRENCY = int(os.environ.get("FINDING_CONCURRENCY", "4"))
 
-def get_index_id_by_name(index_name):
+# Sweep (local-test) path: page size up to 100, number of findings and severity filter
+SWEEP_PAGE_SIZE = int(os.environ.get("SWEEP_PAGE_SIZE", "100"))
+SWEEP_MAX_FINDINGS = int(os.environ.get("SWEEP_MAX_FINDINGS", "2"))
+# Incremental sweeps are bounded by the lambda deadline, 0 takes every finding that fits
+SWEEP_INCREMENTAL_MAX_FINDINGS = int(os.environ.get("SWEEP_INCREMENTAL_MAX_FINDINGS", "0"))
+SWEEP_SEVERITIES = [s for s in os.environ.get("SWEEP_SEVERITIES", "").split(",") if s]
 
-    # List all Kendra indexes
-    response = kendra.list_indices()
+# Batch inference for large backlogs, see batch_handler
+BATCH_BACKEND = os.environ.get("BATCH_BACKEND", "s3")
+BATCH_BUCKET = os.environ.get("BATCH_BUCKET", bucket_name)
+BATCH_ROLE_ARN = os.environ.get("BATCH_ROLE_ARN", "")
+BATCH_DIR = os.environ.get("BATCH_DIR", "/tmp/batch")
 
-    # Search for the index with the given name
-    for index in response['IndexConfigurationSummaryItems']:
-        print(index)
-        if index['Name'] == index_name:
-            return index['Id']
+# Fingerprints of already reported findings, re-emitted unchanged findings are skipped
+finding_index = finding_index_store.index_from_env()
 
-    # If the index is not found, return None or raise an exception
-    return None  # or raise ValueError
+# High-water mark of incremental sweeps, None disables {"sweep": "incremental"}
+sweep_checkpoint_store = sweep_checkpoint.checkpoint_from_env()
 
 
-def query_kendra(kendra_id, query):
-    # Perform the search using Kendra
-    response = kendra.query(
-        IndexId=kendra_id,
-        QueryText=query
+def get_index_id_by_name(index_name):
+    # Cached, paginated and overridable with KENDRA_INDEX_ID
+    return resolvers.kendra_index_id(index_name)
+
+
+def fetch_security_hub_findings(max_items=SWEEP_MAX_FINDINGS, updated_since=None, sort_order='DESC'):
+    # Generator of compact finding records, findings are paged in as they are consumed.
+    # With updated_since only findings updated since then are fetched, max_items=None is no cap
+    return securityhub_findings.iter_findings(
+        page_size=SWEEP_PAGE_SIZE,
+        max_items=max_items,
+        severities=SWEEP_SEVERITIES,
+        updated_since=updated_since,
+        sort_order=sort_order,
     )
 
-    # Extract relevant information from the response
-    results = []
-    for result in response['ResultItems']:
-        document = {
-            'id': result['DocumentId'],
-            'title': result['DocumentTitle']['Text'],
-            'excerpt': result['DocumentExcerpt']['Text'],
-            'uri': result.get('DocumentURI', '')
-        }
-        results.append(document)
-
-    return results
-
-
-def process_prompt(system, prompt):
-
-    body = json.dumps({
-        "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 9186,
-        "system": system,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ]
-            }
-        ]
-    })
-
-    response = bedrock_runtime.invoke_model(
-        # modelId="anthropic.claude-3-sonnet-20240229-v1:0",
-        modelId="amazon.titan-embed-text-v1",
-        contentType="application/json",
-        accept="application/json",
-        body=body
-    )
 
-    response_body = json.loads(response['body'].read())
-    logger.info(f"respone body from api {response_body}")
-    return response_body['content'][0]['text']
+# Incident runbook system prompt, identical on every call so it is the prompt cache prefix
+REPORT_SYSTEM_PROMPT = """You are an AWS Security Engineer looking to improve the security posture of your organization
 
+Generate incident report in below format
+==========================================
 
-def fetch_security_hub_findings():
-    # Create a Security Hub client
+AnyCompany Incident Response Runbook Template
+This playbook is provided as a template for AnyCompany Security Team using AWS products and to build our incident response capability. This template is customized to suit AnyCompany's particular needs, risks, available tools and work processes.
 
-    # Set up parameters for the get_findings API call
-    params = {
-        'MaxResults': 2,  # Adjust this value based on your needs
-        'SortCriteria': [{'Field': 'UpdatedAt', 'SortOrder': 'DESC'}],
-        'Filters': {
-            'RecordState': [{'Value': 'ACTIVE', 'Comparison': 'EQUALS'}],
-            'UpdatedAt': [{'Start': (datetime.now() - timedelta(days=30)).isoformat(), 'End': datetime.now().isoformat()}]
-        }
-    }
+This runbook outlines response steps for security incidents. This runbook is used to –
+• Gather evidence
+• Contain and then eradicate the incident
+• Recover from the incident
+• Conduct post-incident activities, including post-mortem and feedback processes
+
+Incident Summary
+
+Incident Type:
+
+Incident Description:
+
+Incident Response Process:
+
+1. Acquire, preserve, document evidence
+2. Determine the sensitivity, dependency of the resources
+3. Identify the remediation steps
+4. Verify and validate the changes in lower environment
+5. Confirm with respective application teams
+6. Make changes to resolve the incident
+7. Record history and actions
+8. Post activity - perform a root cause analysis, update policies if needed
+
+This report text will be finally saved in word format, so i need output in markdown format.
+Create a detailed report.
+
+"""
+
+
+def report_prompts(finding):
+    return REPORT_SYSTEM_PROMPT, finding_reports.report_prompt(finding)
+
+
+def analyze_finding(kendra_id, event, sinks=None, deadline=None, routes=None):
+    return finding_reports.analyze_finding(kendra_id, event, REPORT_SYSTEM_PROMPT, sinks, deadline, routes)
 
+
+def finding_is_unchanged(index, row):
+    try:
+        return index.is_unchanged(row)
+    except Exception as e:
+        logger.warning(f"Finding index lookup failed for {row.get('Id')}: {str(e)}")
+        return False
+
+
+def process_finding(kendra_id, row, upload_report, open_report_stream=None, deadline=None, index=None):
+    # index is only passed for full security hub findings, the sweep rows are projected
+    # to DEFAULT_FIELDS and miss most of the fields the fingerprint is built from
+    timings = {}
+    routes = {}
+    start = time.perf_counter()
+    if index and finding_is_unchanged(index, row):
+        structured_log.log_stage('event', 'finding_skipped', finding_id=row.get('Id'), reason='unchanged')
+        timings['total'] = round(time.perf_counter() - start, 3)
+        return {"doc": row, "skipped": True, "timings": timings}
+
+    report_stream_sink = None
+    try:
+        if open_report_stream:
+            # The report is uploaded while it is generated, close() finishes the upload
+            report_stream_sink = open_report_stream(row)
+            response = analyze_finding(kendra_id, row, sinks=[report_stream_sink], deadline=deadline, routes=routes)
+            timings['analyze'] = round(time.perf_counter() - start, 3)
+
+            upload_start = time.perf_counter()
+            report_stream_sink.close()
+            timings['upload'] = round(time.perf_counter() - upload_start, 3)
+        else:
+            response = analyze_finding(kendra_id, row, deadline=deadline, routes=routes)
+            timings['analyze'] = round(time.perf_counter() - start, 3)
+
+            upload_start = time.perf_counter()
+            upload_report(row, response[0])
+            timings['upload'] = round(time.perf_counter() - upload_start, 3)
+    except Exception as e:
+        if report_stream_sink:
+            report_stream_sink.abort()
+        logger.exception(f"Error processing finding {row.get('Id')}: {str(e)}")
+        timings['total'] = round(time.perf_counter() - start, 3)
+        return {"doc": row, "error": str(e), "route": routes, "timings": timings}
+
+    if index:
+        try:
+            index.record(row)
+        except Exception as e:
+            logger.warning(f"Finding index update failed for {row.get('Id')}: {str(e)}")
+
+    timings['total'] = round(time.perf_counter() - start, 3)
+    return {"doc": row, "response": response[0], "search_query": response[1], "kendra_docs": response[2], "route": routes, "timings": timings}
+
+
+def iter_processed_findings(kendra_id, findings, upload_report, open_report_stream=None, deadline=None, index=None):
+    # Keeps at most 2 * FINDING_CONCURRENCY findings in flight, so a generator of
+    # findings is consumed as results are produced instead of all up front
+    if FINDING_CONCURRENCY <= 1:
+        for row in findings:
+            yield process_finding(kendra_id, row, upload_report, open_report_stream, deadline, index)
+        return
+
+    with ThreadPoolExecutor(max_workers=FINDING_CONCURRENCY) as executor:
+        pending = deque()
+        for row in findings:
+            pending.append(executor.submit(process_finding, kendra_id, row, upload_report, open_report_stream, deadline, index))
+            if len(pending) >= 2 * FINDING_CONCURRENCY:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def process_findings(kendra_id, findings, upload_report, open_report_stream=None, deadline=None, index=None):
+    # Results keep the input order, a failing finding only marks its own entry
+    return list(iter_processed_findings(kendra_id, findings, upload_report, open_report_stream, deadline, index))
+
+
+def incremental_sweep(kendra_id, max_items=None, deadline=None):
+    # Picks up where the last sweep stopped. The cursor only moves past findings that were
+    # processed, in order, so a failed finding and everything after it are retried next run
+    cursor = sweep_checkpoint_store.load()
+    structured_log.log_stage('event', 'incremental_sweep', updated_since=cursor.get('updated_at'))
+    findings = fetch_security_hub_findings(max_items or SWEEP_INCREMENTAL_MAX_FINDINGS or None, updated_since=cursor.get('updated_at'), sort_order='ASC')
+    findings = sweep_checkpoint.until_deadline(sweep_checkpoint.unseen(findings, cursor), deadline)
+
+    res = []
+    advancing = True
+    for result in iter_processed_findings(kendra_id, findings, upload_docx_report, deadline=deadline):
+        res.append(result)
+        if advancing and 'error' in result:
+            logger.warning(f"Sweep checkpoint held at {cursor.get('updated_at')}, {result['doc'].get('Id')} failed")
+            advancing = False
+        if advancing:
+            cursor = sweep_checkpoint.advance(cursor, result['doc'])
+            sweep_checkpoint_store.save(cursor)
+    return res, cursor
+
+
+def report_file_name(row, extension='md'):
+    id = row['Id'].split("/")[-1]
+    return f'incident_report_{id}.{extension}'
+
+
+def upload_markdown_report(row, report):
+    file_name = report_file_name(row)
+    # s3.upload_fileobj(doc_buffer, bucket_name, file_name)
+    clients.get('s3').put_object(Bucket=bucket_name, Key=file_name, Body=report)
+
+    structured_log.log_stage('event', 'report_uploaded', bucket=bucket_name, key=file_name)
+
+
+def open_report_stream(row):
+    return report_stream.S3MultipartUpload(clients.get('s3'), bucket_name, report_file_name(row))
+
+
+def upload_docx_report(row, report):
+    # python-docx, markdown and lxml are only loaded by the paths that write word reports
+    from docx_report import markdown_to_docx
+
+    # Generate Word document
+    doc = markdown_to_docx(report)
+
+    # Save document to BytesIO object
+    doc_buffer = BytesIO()
+    doc.save(doc_buffer)
+    doc_buffer.seek(0)
+
+    file_name = report_file_name(row, 'docx')
+    clients.get('s3').upload_fileobj(doc_buffer, bucket_name, file_name)
+
+    structured_log.log_stage('event', 'report_uploaded', bucket=bucket_name, key=file_name)
+
+
+def batch_backend():
+    if BATCH_BACKEND == "local":
+        return batch_reports.LocalBatchBackend(BATCH_DIR, lambda model_input: json.loads(
+            clients.get('bedrock-runtime').invoke_model(
+                modelId=finding_reports.MODEL_ID,
+                contentType="application/json",
+                accept="application/json",
+                body=json.dumps(model_input)
+            )['body'].read()))
+    return batch_reports.S3BatchBackend(BATCH_BUCKET, "batch/", BATCH_ROLE_ARN, finding_reports.MODEL_ID)
+
+
+def batch_handler(event):
+    # {"batch": "submit", "max_items": 5000} starts a job from the sweep findings,
+    # {"batch": "collect", "job": <submit result>} writes the reports once it finished
+    backend = batch_backend()
+    if event['batch'] == 'submit':
+        if not event.get('max_items'):
+            return {'statusCode': 400, 'body': json.dumps('max_items is required to submit a batch job')}
+        findings = fetch_security_hub_findings(max_items=event['max_items'])
+        try:
+            job = batch_reports.submit_batch(backend, findings, lambda row: finding_reports.prompt_request(*report_prompts(finding_projection.encode_finding(row))))
+        except ValueError as e:
+            logger.error(f"Batch job not submitted: {str(e)}")
+            return {'statusCode': 400, 'body': json.dumps(str(e))}
+        return {'statusCode': 200, 'job': job}
+
+    job = event['job']
+    status, message = backend.status(job)
+    if status in batch_reports.RUNNING_STATUSES:
+        return {'statusCode': 202, 'job': job, 'status': status}
+    if status in batch_reports.FAILED_STATUSES:
+        logger.error(f"Batch job {job.get('job_name')} ended {status}: {message}")
+        return {'statusCode': 500, 'job': job, 'status': status, 'error': message}
+
+    res = batch_reports.collect_batch(backend, job, upload_markdown_report)
+    return {'statusCode': 200, 'job': job, 'status': status, 'res': res}
+
+
+def sqs_handler(kendra_id, event, deadline):
+    # Each message is an EventBridge security hub event. The findings of the whole batch
+    # share the FINDING_CONCURRENCY window, a message fails if any of its findings failed
+    messages, failed = sqs_batch.parse_records(event['Records'])
+    owners = []
     findings = []
-    max_finding = 2
-    # Paginate through results
-    while True:
-        response = securityhub.get_findings(**params)
-        findings.extend(response['Findings'])
-
-        if (len(findings) > max_finding):
-            break
-        # Check if there are more findings to fetch
-        if 'NextToken' not in response:
-            break
-        params['NextToken'] = response['NextToken']
-
-    # Process and format the findings as needed
-    formatted_findings = []
-    for finding in findings:
-        formatted_finding = {
-            'Id': finding['Id'],
-            'Title': finding['Title'],
-            'Description': finding['Description'],
-            'Severity': finding['Severity']['Label'],
-            'ResourceType': finding['Resources'][0]['Type'] if finding['Resources'] else 'N/A',
-            'UpdatedAt': finding['UpdatedAt']
-        }
-        formatted_findings.append(formatted_finding)
-
-    return formatted_findings
-
-
-def analyze_finding(kendra_id, event):
-    user = f"""I want to search aws opensearch for related documents
-    I want you to review findings from security hub and extract important keywords create a search summary
-    <finding>
-    {jsonpickle.encode(event)}
-    </finding>
-
-    Only return the final query in text format, don't mention anything else
-    Create a query in natural language extracting important terms.
-
-    The final search query should be less than 500 words.
-    """
-    search_query = process_prompt("", user)
-
-    docs = query_kendra(kendra_id, search_query)
-    logger.info('## KENDRA\r' + jsonpickle.encode(docs))
-    system = f"""You are an AWS Security Engineer looking to improve the security posture of your organization
-
-    Generate incident report in below format
-    ==========================================
-
-    AnyCompany Incident Response Runbook Template
-    This playbook is provided as a template for AnyCompany Security Team using AWS products and to build our incident response capability. This template is customized to suit AnyCompany's particular needs, risks, available tools and work processes.
-
-    This runbook outlines response steps for security incidents. This runbook is used to –
-    • Gather evidence
-    • Contain and then eradicate the incident
-    • Recover from the incident
-    • Conduct post-incident activities, including post-mortem and feedback processes
-
-    Incident Summary
-
-    Incident Type:
-
-    Incident Description:
-
-    Incident Response Process:
-
-    1. Acquire, preserve, document evidence
-    2. Determine the sensitivity, dependency of the resources
-    3. Identify the remediation steps
-    4. Verify and validate the changes in lower environment
-    5. Confirm with respective application teams
-    6. Make changes to resolve the incident
-    7. Record history and actions
-    8. Post activity - perform a root cause analysis, update policies if needed
-
-    This report text will be finally saved in word format, so i need output in markdown format.
-    Create a detailed report.
-
-    """
-    user = f"""Review the finding and summarize actionable next steps,
-    <finding>
-    {jsonpickle.encode(event)}
-    </finding>
-
-    This report text will be finally saved in word format, so i need output in markdown format.
-    Create a detailed and in-depth report. 
-    Provide output in proper markdown format with headings/bullet points etc.
-    """
-
-    response = process_prompt(system, user)
-    return response, search_query, docs
+    for message_id, body in messages:
+        rows = body.get('detail', {}).get('findings') if isinstance(body, dict) else None
+        if not isinstance(rows, list):
+            logger.error(f"SQS message {message_id} is not a security hub findings event")
+            failed.append(message_id)
+            continue
+        owners.extend([message_id] * len(rows))
+        findings.extend(rows)
+
+    res = process_findings(kendra_id, findings, upload_markdown_report,
+                           open_report_stream if finding_reports.STREAM_REPORTS else None, deadline, finding_index)
+    failed.extend(dict.fromkeys(message_id for message_id, result in zip(owners, res) if 'error' in result))
+    return res, failed
 
 
 def lambda_handler(event, context):
-    # logger.info('## ENVIRONMENT VARIABLES\r' + jsonpickle.encode(dict(**os.environ)))
-    logger.info('## EVENT\r' + jsonpickle.encode(event))
-    # logger.info('## CONTEXT\r' + jsonpickle.encode(context))
+    serialization.reset()
+    structured_log.log_stage('env', 'environment', lambda: dict(os.environ))
+    structured_log.log_stage('event', 'event', lambda: serialization.encode(event))
+    structured_log.log_stage('context', 'context', lambda: serialization.encode(context))
+    if 'batch' in event:
+        return batch_handler(event)
+
     kendra_id = get_index_id_by_name("example-index")
-    res = []
-    if "local-test" not in jsonpickle.encode(event):
-        for row in event['detail']["findings"]:
-            response = analyze_finding(kendra_id, row)
-            res.append({"doc": row, "response": response[0], "search_query": response[1], "kendra_docs": response[2]})
-            # Generate Word document
-            
-
-            # Upload to S3
-            s3 = boto3.client('s3')
-            bucket_name = 'test-stack-saurabh'  # Replace with your S3 bucket name
-            id = row['Id'].split("/")[-1]
-            file_name = f'incident_report_{id}.md'
-            # s3.upload_fileobj(doc_buffer, bucket_name, file_name)
-            s3.put_object(Bucket=bucket_name, Key=file_name, Body=response[0])
-
-            logger.info(f'Uploaded {file_name} to S3 bucket {bucket_name}')
+    deadline = model_routing.lambda_deadline(context)
+    usage_before = finding_reports.usage_snapshot()
+    failed = None
+    cursor = None
+    if sqs_batch.is_sqs_event(event):
+        res, failed = sqs_handler(kendra_id, event, deadline)
+    elif event.get('sweep') == 'incremental':
+        # {"sweep": "incremental", "max_items": 500} from a schedule
+        if not sweep_checkpoint_store:
+            logger.error("Incremental sweeps need SWEEP_CHECKPOINT_BACKEND to be set.")
+            return {'statusCode': 500, 'body': json.dumps('Sweep checkpoint is not configured')}
+        res, cursor = incremental_sweep(kendra_id, event.get('max_items'), deadline)
+    elif "local-test" not in serialization.encode(event):
+        res = process_findings(kendra_id, event['detail']["findings"], upload_markdown_report,
+                               open_report_stream if finding_reports.STREAM_REPORTS else None, deadline, finding_index)
     else:
         findings = fetch_security_hub_findings()
-        for idx, row in enumerate(findings):
-            response = analyze_finding(kendra_id, row)
-            res.append({"doc": row, "response": response[0], "search_query": response[1], "kendra_docs": response[2]})
-            # Generate Word document
-            doc = markdown_to_docx(response[0])
-
-            # Save document to BytesIO object
-            doc_buffer = BytesIO()
-            doc.save(doc_buffer)
-            doc_buffer.seek(0)
-
-            # Upload to S3
-            s3 = boto3.client('s3')
-            bucket_name = 'test-stack-saurabh'  # Replace with your S3 bucket name
-            id = row['Id'].split("/")[-1]
-            file_name = f'incident_report_{id}.docx'
-            s3.upload_fileobj(doc_buffer, bucket_name, file_name)
-
-            logger.info(f'Uploaded {file_name} to S3 bucket {bucket_name}')
+        res = process_findings(kendra_id, findings, upload_docx_report, deadline=deadline)
 
     result = {
         'statusCode': 200,
-        'response': response,
+        'response': res[-1].get('response') if res else None,
         'res': res,
+        'client_construction': clients.construction_times(),
+        **finding_reports.usage_since(usage_before),
     }
+    if cursor is not None:
+        result['sweep_cursor'] = cursor
+    if failed is not None:
+        return sqs_batch.batch_response(failed, **sqs_batch.result_counts(res))
     return result
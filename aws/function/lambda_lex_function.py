@@ -1,161 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
+import time
 import logging
-import boto3
-import jsonpickle
 import json
 
+import clients
+import context_builder
+import conversation_memory
+import hybrid_retrieval
+import kendra_retrieve
+import llm_cache
+import model_routing
+import resolvers
+import retrieval_cache
+import retrievers
+import serialization
+import structured_log
+import tokens
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-client = boto3.client('lambda')
-
-bedrock = boto3.client('bedrock')
-bedrock_runtime = boto3.client('bedrock-runtime')
-kendra = boto3.client('kendra')
-securityhub = boto3.client('securityhub')
 
 USE_CLAUDE = True
 
+# Published guardrail version to apply, DRAFT is the working copy
+GUARDRAIL_VERSION = os.environ.get("GUARDRAIL_VERSION", "DRAFT")
+
+# Turn pipeline: chain (condense, answer, reply), two_step (condense, answer+reply) or single (one call)
+RAG_PIPELINE = os.environ.get("RAG_PIPELINE", "chain").lower()
+# Per bot alias override by alias name or id, e.g. "ChatbotTestAlias=single,QOGZVCZO5Z=two_step"
+RAG_PIPELINE_BY_ALIAS = dict(
+    item.strip().split("=", 1) for item in os.environ.get("RAG_PIPELINE_BY_ALIAS", "").split(",") if "=" in item)
+
+# Token usage of every bedrock call in this container
+model_usage = tokens.TokenUsage()
+
+# Bedrock response cache, call sites opt in with process_prompt(..., cache=response_cache)
+response_cache = llm_cache.cache_from_env()
+
+# Kendra results, near-duplicate search queries share one kendra call
+kendra_cache = retrieval_cache.cache_from_env()
+
+# Fuse kendra query excerpts and retrieve passages (reciprocal rank fusion) instead of retrieve alone
+HYBRID_RETRIEVAL = os.environ.get("HYBRID_RETRIEVAL", "false").lower() == "true"
+HYBRID_TOKEN_BUDGET = int(os.environ.get("HYBRID_TOKEN_BUDGET", "3000"))
+
 
 def get_guardrail_id(guardrail_name):
     try:
-        response = bedrock.list_guardrails()
-        for guardrail in response['guardrails']:
-            print("guardrail['name']", guardrail['name'])
-            if guardrail['name'] == guardrail_name:
-                print("guardrail", guardrail)
-                return guardrail['arn']
-        print(f"Guardrail '{guardrail_name}' not found.")
-        return None
+        guardrail = resolvers.guardrail(guardrail_name)
     except Exception as e:
-        print(f"Error retrieving guardrail: {str(e)}")
+        logger.error(f"Error retrieving guardrail: {str(e)}")
         return None
+    return guardrail['arn'] if guardrail else None
 
 
 def get_index_id_by_name(index_name):
-    response = kendra.list_indices()
-    for index in response['IndexConfigurationSummaryItems']:
-        print(index)
-        if index['Name'] == index_name:
-            return index['Id']
-    return None
-
-
-def retrieve_kendra_documents(kendra_id, query, page_size=10, page_number=1):
-    kendra = boto3.client('kendra')
-
-    response = kendra.retrieve(
-        IndexId=kendra_id,
-        QueryText=query,
-    )
-
-    results = {
-        'retrieved_documents': [],
-        'warning': response.get('WarningMessage'),
-        'page_size': page_size,
-        'page_number': page_number,
-    }
-
-    for result in response['ResultItems']:
-        document = {
-            # 'id': result['DocumentId'],
-            'title': result['DocumentTitle'],
-            'content': result['Content'],
-            # 'content_type': result['ContentType'],
-            # 'attributes': result.get('Attributes', []),
-            # 'document_uri': result.get('DocumentURI'),
-            'document_attributes': result.get('DocumentAttributes', [])
+    # Cached, paginated and overridable with KENDRA_INDEX_ID
+    return resolvers.kendra_index_id(index_name)
+
+
+def retrieve_kendra_documents(kendra_id, query, page_size=10, page_number=1,
+                              attributes=kendra_retrieve.DEFAULT_ATTRIBUTES):
+    # One page of passages, attributes=None returns every document attribute
+    def fetch():
+        page = kendra_retrieve.retrieve_page(kendra_id, query, page_size, page_number, attributes)
+        return {
+            'retrieved_documents': page['passages'],
+            'warning': page['warning'],
+            'page_size': page_size,
+            'page_number': page_number,
         }
-        results['retrieved_documents'].append(document)
 
-    return results
+    if kendra_cache is None:
+        return fetch()
+    operation = f"retrieve:{page_size}:{page_number}:{','.join(attributes or ['*'])}"
+    return kendra_cache.get_or_fetch(kendra_id, operation, query, fetch)
+
+
+def hybrid_kendra_documents(kendra_id, query):
+    # query and retrieve run side by side, so the fused result costs one kendra round trip
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        excerpts = executor.submit(query_kendra, kendra_id, query)
+        passages = retrieve_kendra_documents(kendra_id, query)['retrieved_documents']
+        documents = hybrid_retrieval.fuse(passages, excerpts.result()['documents'], HYBRID_TOKEN_BUDGET)
+    structured_log.log_stage('kendra', 'hybrid_retrieval', documents=len(documents))
+    return documents
+
+
+def retrieve_documents(kendra_id, query):
+    # RETRIEVER picks kendra retrieve, the local vector index or both
+    def kendra_search(q):
+        if HYBRID_RETRIEVAL:
+            return hybrid_kendra_documents(kendra_id, q)
+        return retrieve_kendra_documents(kendra_id, q)['retrieved_documents']
+
+    documents = retrievers.search(query, kendra_search, retrievers.as_retrieve_result)
+    return {'retrieved_documents': documents}
 
 
 def query_kendra(kendra_id, query):
-    response = kendra.query(
-        IndexId=kendra_id,
-        QueryText=query
-    )
-
-    results = {
-        'query_id': response.get('QueryId'),
-        'total_results': response.get('TotalNumberOfResults'),
-        'execution_time': response.get('QueryExecutionTime'),
-        'suggested_queries': response.get('SuggestedQueries', []),
-        'facets': response.get('FacetResults', []),
-        'documents': []
-    }
+    def fetch():
+        response = clients.get('kendra').query(
+            IndexId=kendra_id,
+            QueryText=query
+        )
 
-    for result in response['ResultItems']:
-        document = {
-            'id': result['DocumentId'],
-            'title': result['DocumentTitle']['Text'],
-            'excerpt': result['DocumentExcerpt']['Text'],
-            'uri': result.get('DocumentURI', ''),
-            'type': result['Type'],
-            'score': result['ScoreAttributes']['ScoreConfidence'],
-            # 'feedback_token': result.get('FeedbackToken'),
-            # 'attributes': result.get('DocumentAttributes', []),
-            # 'additional_attributes': result.get('AdditionalAttributes', [])
+        results = {
+            'query_id': response.get('QueryId'),
+            'total_results': response.get('TotalNumberOfResults'),
+            'execution_time': response.get('QueryExecutionTime'),
+            'suggested_queries': response.get('SuggestedQueries', []),
+            'facets': response.get('FacetResults', []),
+            'documents': []
         }
-        results['documents'].append(document)
 
-    if 'WarningMessage' in response:
-        results['warning'] = response['WarningMessage']
+        for result in response['ResultItems']:
+            document = {
+                'id': result['DocumentId'],
+                'title': result['DocumentTitle']['Text'],
+                'excerpt': result['DocumentExcerpt']['Text'],
+                'uri': result.get('DocumentURI', ''),
+                'type': result['Type'],
+                'score': result['ScoreAttributes']['ScoreConfidence'],
+                # Page numbers let hybrid retrieval match excerpts to retrieve passages
+                'document_attributes': result.get('DocumentAttributes', []),
+                # 'feedback_token': result.get('FeedbackToken'),
+                # 'additional_attributes': result.get('AdditionalAttributes', [])
+            }
+            results['documents'].append(document)
+
+        if 'WarningMessage' in response:
+            results['warning'] = response['WarningMessage']
 
-    return results
+        return results
 
+    if kendra_cache is None:
+        return fetch()
+    return kendra_cache.get_or_fetch(kendra_id, 'query', query, fetch)
 
-def process_prompt(system, prompt, guardrail_id):
+
+def process_prompt(system, prompt, guardrail_id, cache=None, route=None):
 
     if USE_CLAUDE:
-        body = json.dumps({
+        model_id = route['model_id'] if route else "anthropic.claude-3-haiku-20240307-v1:0"  # ,"anthropic.claude-3-sonnet-20240229-v1:0",
+        params = {
             "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 9186,
-            "system": system,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ]
-                }
-            ]
-        })
-        response = bedrock_runtime.invoke_model(
-            modelId="anthropic.claude-3-haiku-20240307-v1:0",  # ,"anthropic.claude-3-sonnet-20240229-v1:0",
-            contentType="application/json",
-            accept="application/json",
-            body=body,
-            guardrailIdentifier=guardrail_id,
-            guardrailVersion="DRAFT"
-        )
+            "max_tokens": route['max_tokens'] if route else model_routing.output_limit(model_id),
+            "guardrailIdentifier": guardrail_id,
+            "guardrailVersion": GUARDRAIL_VERSION,
+        }
 
-        response_body = json.loads(response['body'].read())
-        logger.info(f"respone body from api {response_body}")
-        return response_body['content'][0]['text']
+        def invoke():
+            body = json.dumps({
+                "anthropic_version": params["anthropic_version"],
+                "max_tokens": params["max_tokens"],
+                "system": system,
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": prompt
+                            }
+                        ]
+                    }
+                ]
+            })
+            response = clients.get('bedrock-runtime').invoke_model(
+                modelId=model_id,
+                contentType="application/json",
+                accept="application/json",
+                body=body,
+                guardrailIdentifier=guardrail_id,
+                guardrailVersion=params["guardrailVersion"]
+            )
+
+            response_body = json.loads(response['body'].read())
+            structured_log.log_stage('bedrock', 'bedrock_response', response_body, model_id=model_id)
+            model_usage.add(response_body.get('usage'))
+            return response_body['content'][0]['text']
     else:
-        print(f"prompt {prompt}")
-        body = json.dumps({"inputText": system + "\n" + prompt, "textGenerationConfig": {"maxTokenCount": 4096, "stopSequences": [], "temperature": 0, "topP": 1}})
+        model_id = "amazon.titan-text-lite-v1"
+        params = {"maxTokenCount": min(route['max_tokens'], 4096) if route else 4096, "stopSequences": [], "temperature": 0, "topP": 1}
 
-        response = bedrock_runtime.invoke_model(
-            modelId="amazon.titan-text-lite-v1",
-            contentType="application/json",
-            accept="application/json",
-            body=body
+        def invoke():
+            structured_log.log_stage('prompt', 'prompt', prompt, model_id=model_id)
+            body = json.dumps({"inputText": system + "\n" + prompt, "textGenerationConfig": params})
 
-        )
+            response = clients.get('bedrock-runtime').invoke_model(
+                modelId=model_id,
+                contentType="application/json",
+                accept="application/json",
+                body=body
+
+            )
 
-        response_body = json.loads(response['body'].read())
-        logger.info(f"respone body from api {response_body}")
-        return response_body["results"][0]['outputText']
+            response_body = json.loads(response['body'].read())
+            structured_log.log_stage('bedrock', 'bedrock_response', response_body, model_id=model_id)
+            return response_body["results"][0]['outputText']
 
+    if cache is None:
+        return invoke()
+    return cache.get_or_compute(llm_cache.cache_key(model_id, system, prompt, params), invoke)
 
-def do_qa_with_context(context, query, guardrail_id):
+
+def do_qa_with_context(context, query, guardrail_id, route=None):
     system = f""""""
     user = f"""The following is a friendly conversation between a human and an AI.
     The AI is talkative and provides lots of specific details from its context.
@@ -169,11 +222,11 @@ def do_qa_with_context(context, query, guardrail_id):
     Also provide document title and page number if any document is used from the context to the answer the question.
     Solution:"""
 
-    response = process_prompt(system, user, guardrail_id)
+    response = process_prompt(system, user, guardrail_id, cache=response_cache, route=route)
     return response
 
 
-def generate_final_reply(input, chat_history, context, guardrail_id):
+def generate_final_reply(input, chat_history, context, guardrail_id, route=None):
     system = f""""""
     user = f"""The following is a friendly conversation between a human and an AI.
 
@@ -189,11 +242,11 @@ def generate_final_reply(input, chat_history, context, guardrail_id):
 
     Response:"""
 
-    response = process_prompt(system, user, guardrail_id)
+    response = process_prompt(system, user, guardrail_id, cache=response_cache, route=route)
     return response
 
 
-def generate_query(input, chat_history, guardrail_id):
+def generate_query(input, chat_history, guardrail_id, route=None):
     condense_qa_template = f"""Given the following conversation and a follow up question, rephrase the follow up question
         to be a standalone question.
 
@@ -202,15 +255,113 @@ def generate_query(input, chat_history, guardrail_id):
         Follow Up Input: {input}
         Standalone question:"""
 
-    response = process_prompt("", condense_qa_template, guardrail_id)
+    response = process_prompt("", condense_qa_template, guardrail_id, cache=response_cache, route=route)
     return response
 
 
-def lex_format_response(event, response_text, chat_history, guardrail_id):
+def answer_in_one_call(input, chat_history, context, guardrail_id, route=None):
+    # Condensation, answer and final reply in one call, the model returns them as JSON
+    user = f"""The following is a friendly conversation between a human and an AI.
+    The AI provides specific details from its context. If the AI does not know the answer
+    to a question, it truthfully says it does not know.
+
+    Chat History:
+    {chat_history}
+
+    <context>
+    {context}
+    </context>
+
+    Follow Up Input: {input}
+
+    Rephrase the follow up input as a standalone question using the chat history, then answer
+    that question for the user based on the above documents. Answer "don't know" if it is not
+    present in the documents, and give the document title and page number of every document used.
+
+    Return only a JSON object with the keys "standalone_question", "answer" and "sources" (list of strings)."""
+
+    response = process_prompt("", user, guardrail_id, cache=response_cache, route=route)
+    return parse_structured(response)
+
+
+def answer_condensed(question, chat_history, context, guardrail_id, route=None):
+    # two_step: the question is already standalone, one call answers it and writes the reply
+    user = f"""The following is a friendly conversation between a human and an AI.
+    The AI provides specific details from its context. If the AI does not know the answer
+    to a question, it truthfully says it does not know.
+
+    Chat History:
+    {chat_history}
+
+    <context>
+    {context}
+    </context>
+
+    Question: {question}
+
+    Answer the question for the user based on the above documents. Answer "don't know" if it is not
+    present in the documents, and give the document title and page number of every document used.
+
+    Return only a JSON object with the keys "answer" and "sources" (list of strings)."""
+
+    response = process_prompt("", user, guardrail_id, cache=response_cache, route=route)
+    return {**parse_structured(response), 'standalone_question': question}
+
+
+def parse_structured(text):
+    # The JSON object in the model output, the whole text is the answer when there is none
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            result = json.loads(text[start:end + 1])
+            if isinstance(result, dict) and result.get('answer'):
+                return result
+        except ValueError:
+            pass
+    logger.warning("Structured answer could not be parsed, using the raw model output")
+    return {'standalone_question': None, 'answer': text.strip(), 'sources': []}
+
+
+def pipeline_mode(event):
+    bot = event.get('bot') or {}
+    mode = RAG_PIPELINE_BY_ALIAS.get(bot.get('aliasName')) or RAG_PIPELINE_BY_ALIAS.get(bot.get('aliasId'))
+    return (mode or RAG_PIPELINE).strip().lower()
+
+
+def retrieval_query(user_input, memory):
+    # Without a condensation call, the previous question carries the context of a follow up
+    previous = conversation_memory.last_question(memory)
+    if not previous:
+        return user_input
+    return f"{previous} {user_input}"
+
+
+def summarize_history(summary, turns, guardrail_id):
+    # Rolling summary of the turns that left the memory window, runs beside the turn on the fast model
+    user = f"""Update the summary of a conversation between a human and an AI with the new turns.
+    Keep the resources, controls and findings discussed and any open question, in at most 5 sentences.
+
+    Summary so far: {summary or "none"}
+
+    New turns:
+    {turns}
+
+    Updated summary:"""
+
+    return process_prompt("", user, guardrail_id, route=model_routing.route('condense'))
+
+
+def build_context(docs, query):
+    # Best passages, deduplicated and packed into CONTEXT_TOKEN_BUDGET
+    passages = [context_builder.from_kendra(doc) for doc in docs["retrieved_documents"]]
+    return context_builder.build_context(passages, query)
+
+
+def lex_format_response(event, response_text, memory, guardrail_id):
     event['sessionState']['intent']['state'] = "Fulfilled"
     return {
         'sessionState': {
-            'sessionAttributes': {'chat_history': chat_history},
+            'sessionAttributes': {conversation_memory.MEMORY_ATTRIBUTE: conversation_memory.encode(memory)},
             'dialogAction': {
                 'type': 'Close'
             },
@@ -224,33 +375,43 @@ def lex_format_response(event, response_text, chat_history, guardrail_id):
 
 
 def lambda_handler(event, context):
-    logger.info('## ENVIRONMENT VARIABLES\r' + jsonpickle.encode(dict(**os.environ)))
-    logger.info('## EVENT\r' + jsonpickle.encode(event))
-    logger.info('## CONTEXT\r' + jsonpickle.encode(context))
+    serialization.reset()
+    structured_log.log_stage('env', 'environment', lambda: dict(os.environ))
+    structured_log.log_stage('event', 'event', lambda: serialization.encode(event))
+    structured_log.log_stage('context', 'context', lambda: serialization.encode(context))
 
     env = dict(**os.environ)
 
     guardrail_id = get_guardrail_id("PII-Masking-Guardrail")
 
-    chat_history_str = ""
     response_text = ""
-    if (event['inputTranscript']):
-        user_input = event['inputTranscript']
-        prev_session = event['sessionState']['sessionAttributes']
-
-        print(prev_session)
-
-        if 'chat_history' in prev_session:
-            chat_history = list(tuple(pair) for pair in json.loads(prev_session['chat_history']))
+    user_input = event['inputTranscript']
+    prev_session = event['sessionState'].get('sessionAttributes') or {}
+    structured_log.log_stage('event', 'session', prev_session)
+
+    # Recent turns plus a rolling summary, the summary of evicted turns is refreshed while this turn runs
+    memory = conversation_memory.load(prev_session)
+    summary_update = conversation_memory.start_summary(
+        memory, lambda summary, turns: summarize_history(summary, turns, guardrail_id))
+    chat_history_str = conversation_memory.history_text(memory)
+
+    if (user_input):
+
+        # Lex waits on the whole chain, each step is capped by the time left in the invocation
+        deadline = model_routing.lambda_deadline(context)
+        routes = {purpose: model_routing.route(purpose, deadline=deadline) for purpose in ('condense', 'answer', 'reply')}
+        structured_log.log_stage('event', 'model_routes', routes=routes)
+
+        mode = pipeline_mode(event)
+        turn_start = time.perf_counter()
+        usage_before = model_usage.totals()
+        if mode == 'single':
+            generated_query_text = retrieval_query(user_input, memory)
         else:
-            chat_history = []
-
-        chat_history_str = "\n".join(f"{user}: {message}" for user, message in chat_history)
+            generated_query_text = generate_query(user_input, chat_history_str, guardrail_id, route=routes['condense'])
 
-        generated_query_text = generate_query(user_input, chat_history, guardrail_id)
-
-        print("user input", user_input)
-        print("chat history", chat_history_str)
+        structured_log.log_stage('prompt', 'condensed_query', generated_query_text, user_input=user_input,
+                                 chat_history=chat_history_str, mode=mode)
 
         kendra_id = env["KENDRA_INDEX_ID"]
         kendra_index_name = env["KENDRA_INDEX_NAME"]
@@ -259,24 +420,39 @@ def lambda_handler(event, context):
 
         # response = analyze_finding(kendra_id, "test123")
         # docs = query_kendra(kendra_id, query)
-        docs = retrieve_kendra_documents(kendra_id=kendra_id, query=generated_query_text)
-        context = ""
-        for doc in docs["retrieved_documents"]:
-            context += f"""
-            <document>
-                {jsonpickle.encode(doc)}
-            </document>
-            """
-
-        response = do_qa_with_context(context=context, query=generated_query_text, guardrail_id=guardrail_id)
-        response_text = generate_final_reply(chat_history=chat_history, input=user_input, context=response, guardrail_id=guardrail_id)
-
-    # Append user input and response to chat history. Then only retain last 3 message histories.
-    # It seemed to work better with AI responses removed, but try adding them back in. {response_text}
-    chat_history.append((f"{user_input}", f"..."))
-    chat_history = chat_history[-3:]
-
-    return lex_format_response(event, response_text, json.dumps(chat_history), guardrail_id=guardrail_id)
+        docs = retrieve_documents(kendra_id, generated_query_text)
+        context = build_context(docs, generated_query_text)
+
+        if mode == 'single':
+            result = answer_in_one_call(user_input, chat_history_str, context, guardrail_id, route=routes['answer'])
+            response_text = result['answer']
+        elif mode == 'two_step':
+            result = answer_condensed(generated_query_text, chat_history_str, context, guardrail_id,
+                                      route=routes['answer'])
+            response_text = result['answer']
+        else:
+            response = do_qa_with_context(context=context, query=generated_query_text, guardrail_id=guardrail_id,
+                                          route=routes['answer'])
+            response_text = generate_final_reply(chat_history=chat_history_str, input=user_input, context=response,
+                                                 guardrail_id=guardrail_id, route=routes['reply'])
+
+        usage_after = model_usage.totals()
+        structured_log.log_stage('event', 'turn', mode=mode, latency=round(time.perf_counter() - turn_start, 3),
+                                 usage={field: usage_after[field] - usage_before[field] for field in usage_after})
+
+    # Append user input and response to the memory, answers are kept up to MEMORY_ANSWER_CHARS
+    structured_log.log_stage('event', 'caches',
+                             llm_cache=response_cache.stats() if response_cache else None,
+                             retrieval_cache=kendra_cache.stats() if kendra_cache else None,
+                             client_construction=clients.construction_times())
+
+    conversation_memory.finish_summary(memory, summary_update)
+    if user_input:
+        conversation_memory.add_turn(memory, user_input, response_text)
+    structured_log.log_stage('event', 'memory', turns=len(memory['turns']), pending=len(memory['pending']),
+                             summary_chars=len(memory['summary']))
+
+    return lex_format_response(event, response_text, memory, guardrail_id=guardrail_id)
 
     # result = {
     #     "kendra_id": kendra_id,
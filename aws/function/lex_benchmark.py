@@ -0,0 +1,157 @@
+# Compares Lex turn latency and bedrock tokens of the RAG pipeline modes (RAG_PIPELINE).
+#
+#   python lex_benchmark.py                      # against bedrock / kendra, needs KENDRA_INDEX_ID
+#   python lex_benchmark.py --stub               # offline, bedrock and kendra replaced by a latency model
+#   python lex_benchmark.py --modes chain,single --runs 3 --questions questions.txt
+import argparse
+import copy
+import json
+import os
+import statistics
+import time
+
+import tokens
+
+DEFAULT_QUESTIONS = [
+    ("how do I block public access on an s3 bucket", "which control covers it"),
+    ("what does security hub control EC2.19 check", "how do I remediate it"),
+    ("is MFA required for the root user", "and for IAM users"),
+]
+
+# Stub latency model, roughly claude 3 haiku on bedrock
+STUB_FIRST_TOKEN = 0.35
+STUB_TOKENS_PER_SECOND = 120
+STUB_KENDRA_LATENCY = 0.25
+
+
+class StubBody:
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def read(self):
+        return json.dumps(self.payload).encode('utf-8')
+
+
+class StubBedrock:
+    # Sleeps like the model would and answers in the shape each prompt asks for
+
+    def invoke_model(self, modelId, body, **kwargs):
+        request = json.loads(body)
+        prompt = request['messages'][0]['content'][0]['text']
+        if 'Standalone question:' in prompt:
+            text = "How do I block public access on an S3 bucket?"
+        elif '"standalone_question"' in prompt:
+            text = json.dumps({"standalone_question": "How do I block public access?",
+                               "answer": "Enable S3 Block Public Access. " * 40, "sources": ["controls p.12"]})
+        elif 'JSON object' in prompt:
+            text = json.dumps({"answer": "Enable S3 Block Public Access. " * 40, "sources": ["controls p.12"]})
+        else:
+            text = "Enable S3 Block Public Access on the bucket and account. " * 25
+        output_tokens = min(tokens.estimate_tokens(text), request['max_tokens'])
+        time.sleep(STUB_FIRST_TOKEN + output_tokens / STUB_TOKENS_PER_SECOND)
+        usage = {'input_tokens': tokens.estimate_tokens(request.get('system', '') + prompt), 'output_tokens': output_tokens}
+        return {'body': StubBody({'content': [{'type': 'text', 'text': text}], 'usage': usage})}
+
+
+class StubKendra:
+    # Pages through a fixed set of passages like retrieve does, PageSize/PageNumber and
+    # RequestedDocumentAttributes are honoured
+
+    def __init__(self, passages=5):
+        self.passages = passages
+        self.calls = 0
+
+    def retrieve(self, IndexId, QueryText, PageSize=10, PageNumber=1, RequestedDocumentAttributes=None, **kwargs):
+        time.sleep(STUB_KENDRA_LATENCY)
+        self.calls += 1
+        passage = "Amazon S3 Block Public Access provides settings for access points, buckets and accounts. " * 6
+        items = []
+        for i in range((PageNumber - 1) * PageSize, min(PageNumber * PageSize, self.passages)):
+            attributes = [
+                {'Key': '_excerpt_page_number', 'Value': {'LongValue': i + 1}},
+                {'Key': '_source_uri', 'Value': {'StringValue': f"s3://stub/controls-{i}.pdf"}},
+            ]
+            if RequestedDocumentAttributes:
+                attributes = [a for a in attributes if a['Key'] in RequestedDocumentAttributes]
+            items.append({'DocumentId': f"doc-{i}", 'DocumentTitle': f"AWS Security Hub controls {i}",
+                          'Content': passage, 'DocumentAttributes': attributes})
+        return {'QueryId': f"stub-{self.calls}", 'ResultItems': items}
+
+
+def turn_event(template, text, session_attributes):
+    event = copy.deepcopy(template)
+    event['inputTranscript'] = text
+    event['sessionState']['sessionAttributes'] = session_attributes
+    return event
+
+
+def run_mode(lx, mode, template, questions, runs):
+    lx.RAG_PIPELINE = mode
+    lx.RAG_PIPELINE_BY_ALIAS = {}
+    latencies = []
+    usage = dict.fromkeys(tokens.TokenUsage.FIELDS, 0)
+    turns = 0
+    for _ in range(runs):
+        for conversation in questions:
+            session_attributes = {}
+            for text in conversation:
+                before = lx.model_usage.totals()
+                start = time.perf_counter()
+                response = lx.lambda_handler(turn_event(template, text, session_attributes), None)
+                latencies.append(time.perf_counter() - start)
+                after = lx.model_usage.totals()
+                for field in usage:
+                    usage[field] += after[field] - before[field]
+                turns += 1
+                session_attributes = response['sessionState']['sessionAttributes']
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'turns': turns,
+        'mean_ms': round(statistics.mean(latencies) * 1000),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000),
+        'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000),
+        'input_tokens_per_turn': round(usage['input_tokens'] / turns),
+        'output_tokens_per_turn': round(usage['output_tokens'] / turns),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default="chain,two_step,single")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--questions", help="file with one conversation per line, turns separated by ' | '")
+    parser.add_argument("--event", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lex.json'))
+    parser.add_argument("--stub", action="store_true")
+    args = parser.parse_args()
+
+    if args.stub:
+        os.environ.setdefault("KENDRA_INDEX_ID", "stub-index")
+        os.environ.setdefault("KENDRA_INDEX_NAME", "stub-index")
+        os.environ.setdefault("GUARDRAIL_ID", "stub-guardrail")
+
+    import clients
+    import lambda_lex_function as lx
+
+    if args.stub:
+        clients._clients['bedrock-runtime'] = StubBedrock()
+        clients._clients['kendra'] = StubKendra()
+    # Every turn should pay for its calls
+    lx.response_cache = None
+    lx.kendra_cache = None
+
+    with open(args.event) as f:
+        template = json.load(f)
+    questions = DEFAULT_QUESTIONS
+    if args.questions:
+        with open(args.questions) as f:
+            questions = [tuple(turn.strip() for turn in line.split(" | ")) for line in f if line.strip()]
+
+    for mode in args.modes.split(","):
+        print(json.dumps(run_mode(lx, mode.strip(), template, questions, args.runs)))
+
+
+if __name__ == "__main__":
+    main()
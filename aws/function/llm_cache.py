@@ -0,0 +1,225 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import clients
+
+logger = logging.getLogger()
+
+
+def cache_key(model_id, system, prompt, params=None):
+    # Content address of a bedrock call, same inputs -> same key
+    payload = json.dumps({
+        "modelId": model_id,
+        "system": system,
+        "prompt": prompt,
+        "params": params or {},
+    }, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+
+    def __init__(self, max_entries=256, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+class FileCache:
+    # Local stand-in for the S3 / DynamoDB tier, one json file per key
+
+    def __init__(self, directory, ttl=86400):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item["expires_at"] < time.time():
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            return None
+        return item["value"]
+
+    def set(self, key, value, ttl=None):
+        item = {"value": value, "expires_at": time.time() + (self.ttl if ttl is None else ttl)}
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(item, f)
+        os.replace(tmp_path, self._path(key))
+
+
+class S3Cache:
+
+    def __init__(self, bucket, prefix="llm-cache/", ttl=86400, s3=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl = ttl
+        self._s3 = s3
+
+    @property
+    def s3(self):
+        return self._s3 or clients.get('s3')
+
+    def get(self, key):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        item = json.loads(response['Body'].read())
+        if item["expires_at"] < time.time():
+            return None
+        return item["value"]
+
+    def set(self, key, value, ttl=None):
+        item = {"value": value, "expires_at": time.time() + (self.ttl if ttl is None else ttl)}
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=json.dumps(item))
+
+
+class DynamoDBCache:
+    # Table needs a string hash key "cache_key", enable dynamodb TTL on "expires_at"
+
+    def __init__(self, table_name, ttl=86400, dynamodb=None):
+        self.table_name = table_name
+        self.ttl = ttl
+        self._dynamodb = dynamodb
+
+    @property
+    def dynamodb(self):
+        return self._dynamodb or clients.get('dynamodb')
+
+    def get(self, key):
+        response = self.dynamodb.get_item(TableName=self.table_name, Key={"cache_key": {"S": key}})
+        item = response.get('Item')
+        if not item or int(item["expires_at"]["N"]) < time.time():
+            return None
+        return json.loads(item["value"]["S"])
+
+    def set(self, key, value, ttl=None):
+        expires_at = int(time.time() + (self.ttl if ttl is None else ttl))
+        self.dynamodb.put_item(TableName=self.table_name, Item={
+            "cache_key": {"S": key},
+            "value": {"S": json.dumps(value)},
+            "expires_at": {"N": str(expires_at)},
+        })
+
+
+class ResponseCache:
+
+    def __init__(self, memory=None, persistent=None, ttl=3600):
+        self.memory = memory
+        self.persistent = persistent
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key):
+        if self.memory is not None:
+            value = self.memory.get(key)
+            if value is not None:
+                self._count("memory_hits")
+                return value
+        if self.persistent is not None:
+            try:
+                value = self.persistent.get(key)
+            except Exception as e:
+                # A broken persistent tier should cost a bedrock call, not the invocation
+                logger.warning(f"LLM cache read failed: {str(e)}")
+                self._count("errors")
+                value = None
+            if value is not None:
+                self._count("persistent_hits")
+                if self.memory is not None:
+                    self.memory.set(key, value, self.ttl)
+                return value
+        self._count("misses")
+        return None
+
+    def set(self, key, value):
+        if self.memory is not None:
+            self.memory.set(key, value, self.ttl)
+        if self.persistent is not None:
+            try:
+                self.persistent.set(key, value, self.ttl)
+            except Exception as e:
+                logger.warning(f"LLM cache write failed: {str(e)}")
+                self._count("errors")
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def stats(self, since=None):
+        # since: an earlier stats() result, the counters are then the change since it was taken
+        with self._lock:
+            stats = dict(self._stats)
+        if since:
+            stats = {name: value - since.get(name, 0) for name, value in stats.items()}
+        lookups = stats["memory_hits"] + stats["persistent_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((lookups - stats["misses"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+def cache_from_env():
+    # LLM_CACHE_BACKEND: none (default, no caching) | memory | file | s3 | dynamodb
+    backend = os.environ.get("LLM_CACHE_BACKEND", "none").lower()
+    if backend == "none":
+        return None
+
+    ttl = int(os.environ.get("LLM_CACHE_TTL", "86400"))
+    memory = MemoryCache(max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "256")), ttl=ttl)
+    persistent = None
+    if backend == "file":
+        persistent = FileCache(os.environ.get("LLM_CACHE_DIR", "/tmp/llm-cache"), ttl=ttl)
+    elif backend == "s3":
+        persistent = S3Cache(os.environ["LLM_CACHE_BUCKET"], os.environ.get("LLM_CACHE_PREFIX", "llm-cache/"), ttl=ttl)
+    elif backend == "dynamodb":
+        persistent = DynamoDBCache(os.environ["LLM_CACHE_TABLE"], ttl=ttl)
+    return ResponseCache(memory=memory, persistent=persistent, ttl=ttl)
@@ -0,0 +1,104 @@
+import os
+import time
+
+FAST_MODEL = os.environ.get("MODEL_FAST", "anthropic.claude-3-haiku-20240307-v1:0")
+STRONG_MODEL = os.environ.get("MODEL_STRONG", "anthropic.claude-3-sonnet-20240229-v1:0")
+
+# Config compliance changes carry no severity label
+CONFIG_SEVERITY = os.environ.get("CONFIG_SEVERITY", "MEDIUM")
+
+# Report model and max_tokens per severity, everything not listed uses the fast model.
+# The default models stop at 4096 output tokens, route() caps larger budgets to the model limit
+REPORT_ROUTES = {
+    'CRITICAL': (STRONG_MODEL, 4096),
+    'HIGH': (STRONG_MODEL, 3072),
+    'MEDIUM': (FAST_MODEL, 4096),
+    'LOW': (FAST_MODEL, 2048),
+    'INFORMATIONAL': (FAST_MODEL, 1024),
+}
+
+# Short, mechanical calls always go to the fast model
+PURPOSE_ROUTES = {
+    'query': (FAST_MODEL, 512),
+    'condense': (FAST_MODEL, 512),
+    'answer': (FAST_MODEL, 2048),
+    'reply': (FAST_MODEL, 2048),
+}
+
+# Largest max_tokens each model accepts, bedrock rejects a request above it
+MAX_OUTPUT_TOKENS = {
+    'anthropic.claude-3-haiku-20240307-v1:0': 4096,
+    'anthropic.claude-3-sonnet-20240229-v1:0': 4096,
+    'anthropic.claude-3-opus-20240229-v1:0': 4096,
+    'anthropic.claude-3-5-sonnet-20240620-v1:0': 4096,
+    'anthropic.claude-3-5-haiku-20241022-v1:0': 8192,
+    'anthropic.claude-3-5-sonnet-20241022-v2:0': 8192,
+    'anthropic.claude-3-7-sonnet-20250219-v1:0': 8192,
+}
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+
+# Rough output tokens per second, used to fit a call into the remaining lambda time
+THROUGHPUT = {
+    FAST_MODEL: 120,
+    STRONG_MODEL: 50,
+}
+DEFAULT_THROUGHPUT = 50
+SAFETY_SECONDS = 15
+MIN_REPORT_TOKENS = 1024
+
+
+def finding_severity(event):
+    if not isinstance(event, dict):
+        return None
+    if isinstance(event.get('event'), dict):
+        event = event['event']
+    if event.get('source') == 'aws.config' or 'configRuleName' in (event.get('detail') or {}):
+        return CONFIG_SEVERITY
+    severity = event.get('Severity')
+    if isinstance(severity, dict):
+        severity = severity.get('Label')
+    return severity.upper() if isinstance(severity, str) else None
+
+
+def output_limit(model_id):
+    # Cross-region inference profiles (us.anthropic...) share the limit of the model
+    base = model_id.split('.', 1)[1] if model_id.split('.', 1)[0] in ('us', 'eu', 'apac') else model_id
+    return MAX_OUTPUT_TOKENS.get(base, DEFAULT_MAX_OUTPUT_TOKENS)
+
+
+def lambda_deadline(context):
+    # Wall clock time the invocation is cut off at, None when run outside lambda
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000
+
+
+def affordable_tokens(model_id, deadline):
+    remaining = deadline - time.time() - SAFETY_SECONDS
+    return int(max(remaining, 0) * THROUGHPUT.get(model_id, DEFAULT_THROUGHPUT))
+
+
+def route(purpose, severity=None, deadline=None):
+    # Returns the model and max_tokens for one call, plus why it was picked
+    if purpose == 'report':
+        model_id, max_tokens = REPORT_ROUTES.get(severity or '', (FAST_MODEL, 4096))
+    else:
+        model_id, max_tokens = PURPOSE_ROUTES.get(purpose, (FAST_MODEL, 2048))
+    reason = f"{purpose}/{severity or 'unknown'}"
+
+    if deadline is not None:
+        affordable = affordable_tokens(model_id, deadline)
+        if affordable < max_tokens and model_id != FAST_MODEL and affordable < MIN_REPORT_TOKENS:
+            # Not enough time for the strong model to write a useful report
+            model_id = FAST_MODEL
+            affordable = affordable_tokens(model_id, deadline)
+            reason += "/downgraded"
+        if affordable < max_tokens:
+            max_tokens = max(affordable, 256)
+            reason += "/time-capped"
+
+    if max_tokens > output_limit(model_id):
+        max_tokens = output_limit(model_id)
+        reason += "/model-capped"
+
+    return {'purpose': purpose, 'severity': severity, 'model_id': model_id, 'max_tokens': max_tokens, 'reason': reason}
@@ -0,0 +1,89 @@
+import json
+
+import structured_log
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def iter_text_chunks(response, usage=None):
+    # Text deltas from an anthropic invoke_model_with_response_stream response,
+    # token counts from message_start / message_delta go to usage (a tokens.TokenUsage)
+    for event in response['body']:
+        chunk = event.get('chunk')
+        if not chunk:
+            continue
+        payload = json.loads(chunk['bytes'])
+        if payload.get('type') == 'content_block_delta' and payload['delta'].get('type') == 'text_delta':
+            yield payload['delta']['text']
+        elif payload.get('type') == 'message_start' and usage is not None:
+            usage.add((payload.get('message') or {}).get('usage'))
+        elif payload.get('type') == 'message_delta' and usage is not None:
+            usage.add(payload.get('usage'))
+        elif payload.get('type') == 'message_stop':
+            metrics = payload.get('amazon-bedrock-invocationMetrics')
+            if metrics:
+                structured_log.log_stage('bedrock', 'stream_invocation_metrics', metrics)
+
+
+def write_stream(chunks, *sinks):
+    # Fan chunks out to the sinks as they arrive and return the full text
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        for sink in sinks:
+            sink.write(chunk)
+    return "".join(parts)
+
+
+class S3MultipartUpload:
+    # Buffers at most one part in memory, reports under one part use a single put_object
+
+    def __init__(self, s3, bucket, key, part_size=MIN_PART_SIZE, content_type='text/markdown'):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.content_type = content_type
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+
+    def write(self, text):
+        self.buffer.extend(text.encode('utf-8'))
+        if len(self.buffer) >= self.part_size:
+            self._flush_part()
+
+    def _flush_part(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, ContentType=self.content_type)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+            self.buffer = bytearray()
+            return
+        if self.buffer:
+            self._flush_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts},
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
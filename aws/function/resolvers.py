@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import time
+
+import clients
+
+logger = logging.getLogger()
+
+# Name -> id lookups hit throttled control-plane APIs, cache them for the container lifetime
+RESOLVER_TTL = int(os.environ.get("RESOLVER_TTL", "3600"))
+
+
+class TTLCache:
+
+    def __init__(self, ttl=RESOLVER_TTL):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+        if item is None or item[1] < time.time():
+            return None
+        return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.time() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_kendra_indices = TTLCache()
+# Single flight, one cold thread lists the indices while the others wait for the cache
+_kendra_indices_refresh = threading.Lock()
+
+
+def list_kendra_indices():
+    kendra = clients.get('kendra')
+    params = {}
+    while True:
+        response = kendra.list_indices(**params)
+        for index in response['IndexConfigurationSummaryItems']:
+            yield index
+        if not response.get('NextToken'):
+            break
+        params['NextToken'] = response['NextToken']
+
+
+def kendra_index_id(index_name):
+    override = os.environ.get("KENDRA_INDEX_ID")
+    if override:
+        return override
+
+    cached = _kendra_indices.get(index_name)
+    if cached is not None:
+        return cached or None
+
+    with _kendra_indices_refresh:
+        cached = _kendra_indices.get(index_name)
+        if cached is not None:
+            return cached or None
+
+        # One listing fills the cache for every index name
+        index_id = ''
+        for index in list_kendra_indices():
+            _kendra_indices.set(index['Name'], index['Id'])
+            if index['Name'] == index_name:
+                index_id = index['Id']
+        if not index_id:
+            # Cache the miss too, otherwise every invocation would list again
+            logger.warning(f"Kendra index '{index_name}' not found")
+            _kendra_indices.set(index_name, index_id)
+    return index_id or None
+
+
+_guardrails = TTLCache()
+# Single flight, one cold thread lists the guardrails while the others wait for the cache
+_guardrails_refresh = threading.Lock()
+
+
+def list_guardrails():
+    paginator = clients.get('bedrock').get_paginator('list_guardrails')
+    for page in paginator.paginate():
+        for guardrail in page['guardrails']:
+            yield guardrail
+
+
+def guardrail(guardrail_name):
+    # {'arn': ..., 'version': ...} of the named guardrail, None if there is none
+    override = os.environ.get("GUARDRAIL_ID")
+    if override:
+        return {'arn': override, 'version': os.environ.get("GUARDRAIL_VERSION", "DRAFT")}
+
+    cached = _guardrails.get(guardrail_name)
+    if cached is not None:
+        return cached or None
+
+    with _guardrails_refresh:
+        cached = _guardrails.get(guardrail_name)
+        if cached is not None:
+            return cached or None
+
+        # One listing fills the cache for every guardrail name
+        found = {}
+        for item in list_guardrails():
+            entry = {'arn': item['arn'], 'version': item.get('version')}
+            _guardrails.set(item['name'], entry)
+            if item['name'] == guardrail_name:
+                found = entry
+        if not found:
+            # Cache the miss too, otherwise every turn would list again
+            logger.warning(f"Guardrail '{guardrail_name}' not found")
+            _guardrails.set(guardrail_name, found)
+    return found or None
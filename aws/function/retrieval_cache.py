@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import os
+import re
+import threading
+import time
+
+import structured_log
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'how', 'in', 'is', 'it', 'of',
+    'on', 'or', 'that', 'the', 'this', 'to', 'what', 'when', 'which', 'with',
+))
+
+_token = re.compile(r"[a-z0-9]+(?:[.\-_][a-z0-9]+)*")
+
+
+def normalize(query):
+    # Lower case content words, control ids like "s3.8" or "ec2-19" stay one token
+    return [token for token in _token.findall((query or '').lower()) if token not in STOPWORDS]
+
+
+def shingles(tokens):
+    # Words plus word pairs, so reordered queries still overlap but word order counts for something
+    return frozenset(tokens) | frozenset(zip(tokens, tokens[1:]))
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class RetrievalCache:
+    # Kendra results by (index, operation, query). A query whose shingles are at least
+    # `similarity` Jaccard-similar to a cached one of the same index and operation reuses its results
+
+    def __init__(self, max_entries=256, ttl=3600, similarity=0.7):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "near_hits": 0, "misses": 0, "latency_saved": 0.0}
+
+    def _lookup(self, scope, tokens):
+        # Returns (key, entry, kind) of the best live match, caller holds the lock
+        now = time.time()
+        key = (scope, ' '.join(tokens))
+        entry = self._items.get(key)
+        if entry is not None and entry['expires_at'] >= now:
+            return key, entry, "exact_hits"
+
+        query_shingles = shingles(tokens)
+        best = None
+        best_score = self.similarity
+        for other_key, other in self._items.items():
+            if other_key[0] != scope or other['expires_at'] < now:
+                continue
+            score = jaccard(query_shingles, other['shingles'])
+            if score >= best_score:
+                best, best_score = (other_key, other, "near_hits"), score
+        return best or (key, None, "misses")
+
+    def get_or_fetch(self, index_id, operation, query, fetch):
+        scope = (index_id, operation)
+        tokens = normalize(query)
+        with self._lock:
+            key, entry, kind = self._lookup(scope, tokens)
+            self._stats[kind] += 1
+            if entry is not None:
+                self._stats["latency_saved"] += entry['latency']
+                self._items.move_to_end(key)
+                if kind == "near_hits":
+                    structured_log.log_stage('kendra', 'retrieval_cache_near_hit', query=query, cached_query=key[1])
+                return entry['value']
+
+        start = time.perf_counter()
+        value = fetch()
+        latency = time.perf_counter() - start
+        with self._lock:
+            self._items[key] = {
+                'value': value,
+                'shingles': shingles(tokens),
+                'latency': latency,
+                'expires_at': time.time() + self.ttl,
+            }
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+        return value
+
+    def stats(self, since=None):
+        # since: an earlier stats() result, the counters are then the change since it was taken
+        with self._lock:
+            stats = dict(self._stats)
+            if since:
+                stats = {name: value - since.get(name, 0) for name, value in stats.items()}
+            stats["entries"] = len(self._items)
+        lookups = stats["exact_hits"] + stats["near_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((lookups - stats["misses"]) / lookups, 3) if lookups else 0.0
+        stats["latency_saved"] = round(stats["latency_saved"], 3)
+        return stats
+
+
+def cache_from_env():
+    # RETRIEVAL_CACHE: true (default) | false
+    if os.environ.get("RETRIEVAL_CACHE", "true").lower() != "true":
+        return None
+    return RetrievalCache(
+        max_entries=int(os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES", "256")),
+        ttl=int(os.environ.get("RETRIEVAL_CACHE_TTL", "3600")),
+        similarity=float(os.environ.get("RETRIEVAL_CACHE_SIMILARITY", "0.7")),
+    )
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+import vector_index
+
+logger = logging.getLogger()
+
+# kendra | local | both, local searches the vector index built by vector_index.py
+RETRIEVER = os.environ.get("RETRIEVER", "kendra").lower()
+LOCAL_TOP_K = int(os.environ.get("LOCAL_TOP_K", "5"))
+
+
+def use_kendra():
+    return RETRIEVER in ('kendra', 'both')
+
+
+def use_local():
+    return RETRIEVER in ('local', 'both')
+
+
+def local_documents(query, k=LOCAL_TOP_K):
+    # A missing or broken index degrades to no local results instead of failing the request
+    try:
+        return vector_index.load_index().search(query, k)
+    except Exception as e:
+        logger.warning(f"Local vector search failed: {str(e)}")
+        return []
+
+
+def as_query_result(hit):
+    # Shape of a kendra query result item in query_kendra
+    return {'id': hit['id'], 'title': hit['title'], 'excerpt': hit['content'], 'uri': hit.get('uri', ''), 'score': hit['score']}
+
+
+def as_retrieve_result(hit):
+    # Shape of a kendra retrieve result item in retrieve_kendra_documents
+    attributes = [{'Key': '_excerpt_page_number', 'Value': {'LongValue': hit['page']}}] if hit.get('page') else []
+    return {'title': hit['title'], 'content': hit['content'], 'document_attributes': attributes}
+
+
+def search(query, kendra_search, to_document, k=LOCAL_TOP_K):
+    # kendra_search(query) returns documents in the caller's shape, to_document maps local hits to it.
+    # With both retrievers the kendra call and the local search run side by side, kendra results first
+    if not use_local():
+        return list(kendra_search(query))
+    if not use_kendra():
+        return [to_document(hit) for hit in local_documents(query, k)]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        kendra = executor.submit(kendra_search, query)
+        local = [to_document(hit) for hit in local_documents(query, k)]
+        return list(kendra.result()) + local
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta, timezone
+
+import clients
+
+# get_findings accepts at most 100 results per page
+MAX_PAGE_SIZE = 100
+
+# Compact record shape, output name -> dotted path into the raw finding
+DEFAULT_FIELDS = {
+    'Id': 'Id',
+    'Title': 'Title',
+    'Description': 'Description',
+    'Severity': 'Severity.Label',
+    'ResourceType': 'Resources.0.Type',
+    'UpdatedAt': 'UpdatedAt',
+}
+
+
+def get_path(finding, path):
+    value = finding
+    for part in path.split('.'):
+        if isinstance(value, list):
+            try:
+                value = value[int(part)]
+            except (ValueError, IndexError):
+                return None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+        if value is None:
+            return None
+    return value
+
+
+def project(finding, fields=None):
+    return {name: get_path(finding, path) for name, path in (fields or DEFAULT_FIELDS).items()}
+
+
+def string_filter(values, comparison='EQUALS'):
+    return [{'Value': value, 'Comparison': comparison} for value in values]
+
+
+def finding_filters(days=30, severities=None, product_names=None, generator_ids=None, updated_since=None):
+    filters = {
+        'RecordState': [{'Value': 'ACTIVE', 'Comparison': 'EQUALS'}],
+    }
+    if updated_since:
+        # Incremental sweeps, Start is inclusive so findings at exactly updated_since come back again
+        filters['UpdatedAt'] = [{'Start': updated_since, 'End': datetime.now(timezone.utc).isoformat()}]
+    elif days:
+        now = datetime.now()
+        filters['UpdatedAt'] = [{'Start': (now - timedelta(days=days)).isoformat(), 'End': now.isoformat()}]
+    if severities:
+        filters['SeverityLabel'] = string_filter(severities)
+    if product_names:
+        filters['ProductName'] = string_filter(product_names)
+    if generator_ids:
+        filters['GeneratorId'] = string_filter(generator_ids)
+    return filters
+
+
+def iter_findings(page_size=MAX_PAGE_SIZE, max_items=None, severities=None, product_names=None,
+                  generator_ids=None, fields=None, days=30, filters=None, updated_since=None, sort_order='DESC'):
+    # Yields one projected finding at a time, only the current page is held in memory
+    pagination = {'PageSize': min(page_size, MAX_PAGE_SIZE)}
+    if max_items:
+        pagination['MaxItems'] = max_items
+
+    paginator = clients.get('securityhub').get_paginator('get_findings')
+    pages = paginator.paginate(
+        Filters=filters or finding_filters(days, severities, product_names, generator_ids, updated_since),
+        SortCriteria=[{'Field': 'UpdatedAt', 'SortOrder': sort_order}],
+        PaginationConfig=pagination,
+    )
+    for page in pages:
+        for finding in page['Findings']:
+            yield project(finding, fields)
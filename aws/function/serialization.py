@@ -0,0 +1,74 @@
+import json
+import threading
+
+import jsonpickle
+
+# id(obj) -> (obj, text) for the current invocation, the object is kept so its id is not reused.
+# Payloads are not mutated after they are first logged, call reset() at the start of every invocation.
+_memo = {}
+_memo_lock = threading.Lock()
+
+
+def reset():
+    with _memo_lock:
+        _memo.clear()
+
+
+def dumps(obj):
+    # Plain JSON for dict/list/str/number payloads, jsonpickle only for anything json can not encode
+    try:
+        return json.dumps(obj)
+    except (TypeError, ValueError):
+        return jsonpickle.encode(obj)
+
+
+def encode(obj):
+    # Encodes obj at most once per invocation
+    key = id(obj)
+    with _memo_lock:
+        cached = _memo.get(key)
+    if cached is not None and cached[0] is obj:
+        return cached[1]
+    text = dumps(obj)
+    with _memo_lock:
+        _memo[key] = (obj, text)
+    return text
+
+
+if __name__ == "__main__":
+    # Benchmark: python serialization.py [event.json]
+    import os
+    import sys
+    import time
+
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'event.json')
+    with open(path) as f:
+        event = json.load(f)
+    finding = event['detail']['findings'][0]
+
+    def jsonpickle_request():
+        # Event log line, local-test check, two prompts and the kendra log
+        jsonpickle.encode(event)
+        jsonpickle.encode(event)
+        jsonpickle.encode(finding)
+        jsonpickle.encode(finding)
+        jsonpickle.encode([finding])
+
+    docs = [finding]
+
+    def memo_request():
+        reset()
+        encode(event)
+        encode(event)
+        encode(finding)
+        encode(finding)
+        encode(docs)
+
+    runs = 2000
+    for name, request in (('jsonpickle x5', jsonpickle_request), ('memoized json', memo_request)):
+        request()
+        start = time.perf_counter()
+        for _ in range(runs):
+            request()
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"{name}: {elapsed * 1e6:.1f} us per request ({len(json.dumps(event))} byte event)")
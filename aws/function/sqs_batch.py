@@ -0,0 +1,64 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+
+logger = logging.getLogger()
+
+
+def is_sqs_event(event):
+    # Only the first record is looked at, a batch always comes from one event source mapping
+    records = event.get('Records') if isinstance(event, dict) else None
+    return bool(records) and isinstance(records, list) and records[0].get('eventSource') == 'aws:sqs'
+
+
+def parse_records(records):
+    # (message id, body) for every record whose body is JSON, plus the ids of the ones that are not
+    messages = []
+    failed = []
+    for record in records:
+        try:
+            messages.append((record['messageId'], json.loads(record['body'])))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Unreadable SQS record {record.get('messageId')}: {str(e)}")
+            failed.append(record.get('messageId'))
+    return messages, failed
+
+
+def batch_response(failed, **fields):
+    # Lambda only retries the listed messages when the mapping has ReportBatchItemFailures enabled
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed if message_id], **fields}
+
+
+def result_counts(res):
+    # SQS replies carry counts only, the per-finding results could pass the 6 MB response limit
+    return {
+        'results': len(res),
+        'errors': sum(1 for entry in res if 'error' in entry),
+        'skipped': sum(1 for entry in res if entry.get('skipped')),
+    }
+
+
+def process_messages(messages, handle, concurrency=1):
+    # Runs handle(body) for each (message id, body) with at most 2 * concurrency messages in flight.
+    # Returns (message id, result, error) in input order, an exception only fails its own message
+    def run(message_id, body):
+        try:
+            return message_id, handle(body), None
+        except Exception as e:
+            logger.exception(f"Error processing SQS message {message_id}: {str(e)}")
+            return message_id, None, str(e)
+
+    if concurrency <= 1:
+        return [run(message_id, body) for message_id, body in messages]
+
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for message_id, body in messages:
+            pending.append(executor.submit(run, message_id, body))
+            if len(pending) >= 2 * concurrency:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    return results
@@ -0,0 +1,67 @@
+import logging
+import os
+import time
+
+from llm_cache import DynamoDBCache, FileCache, S3Cache
+
+logger = logging.getLogger()
+
+# Checkpoints should outlive any gap between scheduled sweeps
+CHECKPOINT_TTL = 365 * 86400
+
+# Stop pulling new findings this long before the lambda times out, so the cursor is saved cleanly
+SWEEP_RESERVE_SECONDS = int(os.environ.get("SWEEP_RESERVE_SECONDS", "60"))
+
+
+def advance(cursor, row):
+    # Cursor = newest UpdatedAt processed plus the ids seen at exactly that timestamp,
+    # findings come back oldest first so UpdatedAt never goes backwards
+    updated_at = row.get('UpdatedAt')
+    if not updated_at:
+        return cursor
+    if updated_at != cursor.get('updated_at'):
+        return {'updated_at': updated_at, 'ids': [row.get('Id')]}
+    return {'updated_at': updated_at, 'ids': cursor.get('ids', []) + [row.get('Id')]}
+
+
+def unseen(findings, cursor):
+    # UpdatedAt filters are inclusive, drop the findings already processed at the cursor timestamp
+    seen = set(cursor.get('ids', []))
+    for row in findings:
+        if row.get('UpdatedAt') == cursor.get('updated_at') and row.get('Id') in seen:
+            continue
+        yield row
+
+
+def until_deadline(findings, deadline, reserve=SWEEP_RESERVE_SECONDS):
+    for row in findings:
+        if deadline is not None and time.time() > deadline - reserve:
+            logger.info("Sweep is running out of time, the rest is picked up by the next run")
+            return
+        yield row
+
+
+class SweepCheckpoint:
+
+    def __init__(self, store, name="security-hub-sweep"):
+        self.store = store
+        self.name = name
+
+    def load(self):
+        return self.store.get(self.name) or {}
+
+    def save(self, cursor):
+        self.store.set(self.name, cursor)
+
+
+def checkpoint_from_env():
+    # SWEEP_CHECKPOINT_BACKEND: none | file | s3 | dynamodb
+    backend = os.environ.get("SWEEP_CHECKPOINT_BACKEND", "none").lower()
+    name = os.environ.get("SWEEP_CHECKPOINT_NAME", "security-hub-sweep")
+    if backend == "file":
+        return SweepCheckpoint(FileCache(os.environ.get("SWEEP_CHECKPOINT_DIR", "/tmp/sweep-checkpoint"), ttl=CHECKPOINT_TTL), name)
+    if backend == "s3":
+        return SweepCheckpoint(S3Cache(os.environ["SWEEP_CHECKPOINT_BUCKET"], os.environ.get("SWEEP_CHECKPOINT_PREFIX", "sweep-checkpoint/"), ttl=CHECKPOINT_TTL), name)
+    if backend == "dynamodb":
+        return SweepCheckpoint(DynamoDBCache(os.environ["SWEEP_CHECKPOINT_TABLE"], ttl=CHECKPOINT_TTL), name)
+    return None
@@ -0,0 +1,33 @@
+import re
+import threading
+
+# Claude / Titan tokenizers average ~4 characters per token on English and JSON,
+# words and punctuation runs are counted so short dense strings are not undercounted
+_PIECES = re.compile(r"\w+|[^\w\s]+")
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return max(len(text) // 4, len(_PIECES.findall(text)) * 3 // 4)
+
+
+class TokenUsage:
+    # Running totals of the usage block bedrock returns for anthropic models
+
+    FIELDS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = dict.fromkeys(self.FIELDS, 0)
+
+    def add(self, usage):
+        if not usage:
+            return
+        with self._lock:
+            for field in self.FIELDS:
+                self._totals[field] += usage.get(field) or 0
+
+    def totals(self):
+        with self._lock:
+            return dict(self._totals)
@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import threading
+
+import clients
+
+logger = logging.getLogger()
+
+EMBED_MODEL_ID = os.environ.get("EMBED_MODEL_ID", "amazon.titan-embed-text-v1")
+
+# Built by `python vector_index.py build ...` into layer/vector-index, which the layer mounts at /opt
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "/opt/vector-index")
+
+VECTORS_FILE = "vectors.npy"
+METADATA_FILE = "metadata.jsonl"
+
+CHUNK_CHARS = 1500
+CHUNK_OVERLAP = 200
+# Rows scored per step, float16 rows are widened to float32 a block at a time
+SCORE_BLOCK = 8192
+
+
+def embed(text):
+    response = clients.get('bedrock-runtime').invoke_model(
+        modelId=EMBED_MODEL_ID,
+        contentType="application/json",
+        accept="application/json",
+        body=json.dumps({"inputText": text}),
+    )
+    return json.loads(response['body'].read())['embedding']
+
+
+def chunk_text(text, size=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    # Fixed size windows that prefer to end on a paragraph or sentence break
+    text = text.strip()
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = max(text.rfind("\n\n", start, end), text.rfind(". ", start, end))
+            if cut > start + size // 2:
+                end = cut + 1
+        chunk = text[start:end].strip()
+        if chunk:
+            yield chunk
+        if end == len(text):
+            return
+        # Overlap the next window with this one, starting on a word boundary
+        start = max(end - overlap, start + 1)
+        space = text.find(" ", start, end)
+        if space != -1:
+            start = space + 1
+
+
+class VectorIndex:
+    # Unit length float16 embeddings, memory-mapped, plus one metadata line per row
+
+    def __init__(self, directory=VECTOR_INDEX_DIR):
+        import numpy as np
+
+        self.np = np
+        self.vectors = np.load(os.path.join(directory, VECTORS_FILE), mmap_mode='r')
+        with open(os.path.join(directory, METADATA_FILE)) as f:
+            self.metadata = [json.loads(line) for line in f if line.strip()]
+        logger.info(f"Loaded vector index {directory} with {len(self.metadata)} chunks")
+
+    def search_vector(self, vector, k=5):
+        np = self.np
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        scores = np.empty(self.vectors.shape[0], dtype=np.float32)
+        for start in range(0, self.vectors.shape[0], SCORE_BLOCK):
+            block = self.vectors[start:start + SCORE_BLOCK]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [{**self.metadata[i], 'score': float(scores[i])} for i in top]
+
+    def search(self, query, k=5):
+        return self.search_vector(embed(query), k)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def load_index():
+    # One mapped index per container
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = VectorIndex(VECTOR_INDEX_DIR)
+    return _index
+
+
+def read_source(source):
+    # Local path or s3://bucket/key, pdf pages are extracted with pypdf (only needed for the build)
+    if source.startswith("s3://"):
+        bucket, key = source[5:].split("/", 1)
+        data = clients.get('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+
+    if source.lower().endswith(".pdf"):
+        from io import BytesIO
+        from pypdf import PdfReader
+
+        reader = PdfReader(BytesIO(data))
+        return [(page_number, page.extract_text() or "") for page_number, page in enumerate(reader.pages, 1)]
+    return [(None, data.decode('utf-8', errors='replace'))]
+
+
+def list_sources(sources):
+    # Expands s3://bucket/prefix/ into the objects below it
+    for source in sources:
+        if source.startswith("s3://") and source.endswith("/"):
+            bucket, prefix = source[5:].split("/", 1)
+            paginator = clients.get('s3').get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for item in page.get('Contents', []):
+                    if not item['Key'].endswith("/"):
+                        yield f"s3://{bucket}/{item['Key']}"
+        else:
+            yield source
+
+
+def build_index(sources, directory, embed_text=embed):
+    # Offline build step, chunks and embeds every source into directory
+    import numpy as np
+
+    vectors = []
+    metadata = []
+    for source in list_sources(sources):
+        title = source.rsplit("/", 1)[-1]
+        for page_number, text in read_source(source):
+            for chunk in chunk_text(text):
+                vector = np.asarray(embed_text(chunk), dtype=np.float32)
+                vectors.append(vector / (np.linalg.norm(vector) or 1.0))
+                metadata.append({
+                    'id': f"{source}#{len(metadata)}",
+                    'title': title,
+                    'uri': source,
+                    'page': page_number,
+                    'content': chunk,
+                })
+        logger.info(f"Embedded {source}, {len(metadata)} chunks so far")
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, VECTORS_FILE), np.vstack(vectors).astype(np.float16))
+    with open(os.path.join(directory, METADATA_FILE), 'w') as f:
+        for entry in metadata:
+            f.write(json.dumps(entry) + "\n")
+    return len(metadata)
+
+
+if __name__ == "__main__":
+    # Build:     python vector_index.py build aws-security-controls.pdf s3://bucket/docs/ --out layer/vector-index
+    # Benchmark: python vector_index.py bench [rows]
+    import argparse
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build")
+    build.add_argument("sources", nargs="+")
+    build.add_argument("--out", default="layer/vector-index")
+    bench = commands.add_parser("bench")
+    bench.add_argument("rows", nargs="?", type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        print(f"{build_index(args.sources, args.out)} chunks written to {args.out}")
+    else:
+        import tempfile
+
+        import numpy as np
+
+        directory = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((args.rows, 1536)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.save(os.path.join(directory, VECTORS_FILE), matrix.astype(np.float16))
+        with open(os.path.join(directory, METADATA_FILE), 'w') as f:
+            for i in range(args.rows):
+                f.write(json.dumps({'id': str(i)}) + "\n")
+
+        index = VectorIndex(directory)
+        query = matrix[42]
+        index.search_vector(query)
+        runs = 50
+        start = time.perf_counter()
+        for _ in range(runs):
+            top = index.search_vector(query, k=5)
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"top-5 over {args.rows} x 1536 float16 rows in {elapsed * 1000:.1f} ms, best {top[0]['id']} {top[0]['score']:.3f}")
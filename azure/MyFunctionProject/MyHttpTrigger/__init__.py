@@ -5,6 +5,9 @@ import openai
 import requests
 import json
 
+import context_builder
+import structured_log
+
 
 def pii_recognition_api(language_key, language_endpoint, text):
     url = f"{language_endpoint}/language/:analyze-text?api-version=2022-05-01"
@@ -89,13 +92,17 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         search_response.raise_for_status()  # Raise an exception for bad status codes
         search_results = search_response.json()
 
-        # Extract content from search results
-        context = "\n".join([doc['content'] for doc in search_results.get('value', [])])
-        print("got context ", context)
-
+        # Best passages of the search results, deduplicated and packed into CONTEXT_TOKEN_BUDGET
+        passages = [
+            context_builder.passage(doc['content'], title=f"Search result {number}", score=doc.get('@search.score'))
+            for number, doc in enumerate(search_results.get('value', []), 1)
+        ]
+        context = context_builder.build_context(passages, query)
         redacted_text = pii_recognition_api(language_key, language_endpoint, context)
 
-        print(f"redacted text {redacted_text}")
+        # Only the PII redacted context is logged
+        structured_log.log_stage('search', 'search_context', redacted_text,
+                                 results=len(search_results.get('value', [])), chars=len(context))
 
         # Prepare prompt for GPT-4o-mini
         prompt = f"Based on the following context, answer the query: '{query}'\n\nContext:\n{context}"
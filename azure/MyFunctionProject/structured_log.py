@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import random
+import re
+import time
+
+# Same module ships with the aws lambdas (aws/function/structured_log.py), keep them in sync
+
+# Fraction of stage lines emitted per category, override with LOG_SAMPLING="event=1,bedrock=0.25,env=0"
+DEFAULT_RATES = {
+    'env': 0.0,
+    'context': 0.0,
+    'event': 1.0,
+    'prompt': 0.0,
+    'bedrock': 0.1,
+    'kendra': 0.1,
+    'search': 0.1,
+}
+LOG_MAX_CHARS = int(os.environ.get("LOG_MAX_CHARS", 4096))
+
+SECRET_NAME = re.compile(r'KEY|SECRET|TOKEN|PASSWORD|CREDENTIAL|SESSION|CONNECTION_STRING', re.IGNORECASE)
+REDACTED = '***'
+
+logger = logging.getLogger()
+
+
+def parse_rates(text):
+    rates = {}
+    for item in (text or '').split(','):
+        if '=' not in item:
+            continue
+        name, rate = item.split('=', 1)
+        try:
+            rates[name.strip()] = float(rate)
+        except ValueError:
+            logger.warning(f"Ignoring LOG_SAMPLING entry {item}")
+    return rates
+
+
+RATES = {**DEFAULT_RATES, **parse_rates(os.environ.get("LOG_SAMPLING"))}
+
+# Values of secret looking env vars, replaced wherever they show up in a payload
+_secret_values = sorted(
+    (value for name, value in os.environ.items() if SECRET_NAME.search(name) and len(value) >= 8),
+    key=len, reverse=True)
+
+
+def sampled(category):
+    rate = RATES.get(category, 1.0)
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def redact_text(text):
+    for value in _secret_values:
+        if value in text:
+            text = text.replace(value, REDACTED)
+    return text
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {key: REDACTED if isinstance(key, str) and SECRET_NAME.search(key) else redact(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    return value
+
+
+def truncate(text, limit=LOG_MAX_CHARS):
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...[{len(text) - limit} more chars]"
+
+
+def log_stage(category, stage, payload=None, level=logging.INFO, **fields):
+    # One JSON line per stage. payload may be a callable so the (possibly expensive)
+    # serialization only runs when the line is actually emitted
+    if not logger.isEnabledFor(level) or not sampled(category):
+        return False
+    if callable(payload):
+        payload = payload()
+
+    record = {'stage': stage, 'category': category, 'ts': round(time.time(), 3)}
+    record.update(redact(fields))
+    if payload is not None:
+        text = payload if isinstance(payload, str) else json.dumps(redact(payload), default=str)
+        record['payload'] = truncate(redact_text(text))
+    logger.log(level, json.dumps(record, default=str))
+    return True